@@ -0,0 +1,349 @@
+"""Benchmark end-to-end di MultiAIExtractor contro un finto endpoint Gemini locale.
+
+Avvia un server HTTP che imita `generateContent` (latenza, percentuale di 429 e risposte
+prese dai gemini_results_*.json esistenti), genera PDF di volantino sintetici ed esegue
+l'estrazione completa (rendering, analisi, card, log dei risultati) senza consumare quota.
+
+Esempi:
+    python bench_extraction.py --flyers 2 --pages 24 --latency-ms 900 --rate-429 0.05
+    python bench_extraction.py --pages 24 --batch-pages 8 --batch-output-tokens 8192
+
+Riporta pagine/minuto, p50/p95 della latenza per pagina, RSS di picco, CPU del processo
+e tempo per fase ricavato dalle metriche di deco (le stesse esposte su /metrics).
+Il tempo per fase è tempo reale (wall clock) sommato su tutti i thread, non CPU: con le
+pagine in parallelo include le attese di rete e di lock e può superare la durata del run.
+La CPU effettiva è solo quella complessiva del processo (cpu_seconds).
+"""
+import argparse
+import contextlib
+import glob
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Campi aggiunti dalla pipeline, da togliere per ottenere risposte "grezze" come quelle di Gemini
+DERIVED_FIELDS = ("pagina", "job_id", "supermercato", "immagine_prodotto_card", "prezzo_float", "db_id",
+                  "volantino_url", "volantino_name", "volantino_validita")
+
+
+def load_canned_pages(pattern):
+    """Raggruppa per pagina i prodotti dei risultati esistenti: ogni gruppo è una risposta simulata."""
+    pages = []
+    for fp in sorted(glob.glob(pattern)):
+        with open(fp, "r", encoding="utf-8") as f:
+            products = json.load(f).get("products", [])
+        by_page = {}
+        for p in products:
+            by_page.setdefault((fp, p.get("pagina")), []).append({k: v for k, v in p.items() if k not in DERIVED_FIELDS})
+        pages.extend(by_page.values())
+    if not pages:
+        pages = [[{"nome": "Pasta di semola", "marca": "Deco", "categoria": "Pasta", "prezzo": "0,89"}]]
+    # Riquadri fittizi in griglia, così anche la generazione delle card lavora come in produzione
+    for group in pages:
+        for i, p in enumerate(group):
+            if not p.get("box_2d"):
+                row, col = divmod(i, 3)
+                p["box_2d"] = [row * 250, col * 333, row * 250 + 240, col * 333 + 320]
+    return pages
+
+
+class FakeGemini:
+    """Server locale compatibile con POST /v1beta/models/<modello>:generateContent."""
+
+    def __init__(self, canned_pages, latency_ms, jitter_ms, rate_429, retry_after, seed):
+        self.canned_pages = canned_pages
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counter = 0
+        self.stats = {"requests": 0, "429": 0}
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def _next(self, images):
+        """Latenza e prodotti per ciascuna delle `images` immagini della richiesta (None = risposta 429)."""
+        with self.lock:
+            self.stats["requests"] += 1
+            delay = max(0.0, self.random.gauss(self.latency, self.jitter)) if self.jitter else self.latency
+            throttled = self.random.random() < self.rate_429
+            if throttled:
+                self.stats["429"] += 1
+                return delay, None
+            groups = []
+            for _ in range(images):
+                groups.append(self.canned_pages[self.counter % len(self.canned_pages)])
+                self.counter += 1
+            return delay, groups
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                parts = request.get("contents", [{}])[0].get("parts", [])
+                images = max(1, sum(1 for part in parts if "inline_data" in part))
+                max_tokens = request.get("generationConfig", {}).get("maxOutputTokens", 4096)
+                delay, groups = fake._next(images)
+                time.sleep(delay)
+                if groups is None:
+                    body = json.dumps({"error": {"code": 429, "status": "RESOURCE_EXHAUSTED"}}).encode()
+                    self.send_response(429)
+                    self.send_header("Retry-After", str(fake.retry_after))
+                else:
+                    # Con più immagini ogni prodotto indica la sua, come chiede il prompt batch
+                    products = [dict(p, immagine=k) if images > 1 else p
+                                for k, group in enumerate(groups, start=1) for p in group]
+                    text = json.dumps({"prodotti": products}, ensure_ascii=False)
+                    output_tokens = len(text) // 4
+                    finish_reason = "STOP"
+                    if output_tokens > max_tokens:
+                        text, output_tokens, finish_reason = text[:max_tokens * 4], max_tokens, "MAX_TOKENS"
+                    body = json.dumps({
+                        "candidates": [{"content": {"parts": [{"text": text}]}, "finishReason": finish_reason}],
+                        "usageMetadata": {"candidatesTokenCount": output_tokens,
+                                          "totalTokenCount": 1500 * images + output_tokens},
+                    }).encode()
+                    self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+
+def make_flyer_pdf(path, pages, seed):
+    """PDF sintetico: per pagina una "foto" rumorosa a tutta pagina e una griglia di box prodotto con testo."""
+    import fitz
+    from PIL import Image
+
+    rnd = random.Random(seed)
+    doc = fitz.open()
+    for page_number in range(pages):
+        page = doc.new_page(width=595, height=842)
+        noise = Image.effect_noise((800, 1130), 40 + rnd.random() * 40).convert("RGB")
+        buffer = BytesIO()
+        noise.save(buffer, "JPEG", quality=80)
+        page.insert_image(page.rect, stream=buffer.getvalue())
+        for i in range(9):
+            row, col = divmod(i, 3)
+            rect = fitz.Rect(20 + col * 190, 40 + row * 260, 190 + col * 190, 280 + row * 260)
+            page.draw_rect(rect, color=(0.8, 0.1, 0.1), fill=(1, 1, 0.9), width=2)
+            page.insert_text(rect.tl + (10, 30), f"Prodotto {page_number + 1}.{i + 1}", fontsize=14)
+            page.insert_text(rect.tl + (10, 200), f"{rnd.randint(0, 9)},{rnd.randint(10, 99)} €", fontsize=28, color=(0.8, 0, 0))
+    doc.save(path)
+    doc.close()
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def stage_totals(metrics):
+    """Somma (tempo reale, non CPU) e conteggio di ogni istogramma di durata di deco, su tutte le etichette."""
+    totals = {}
+    for name, (kind, _, _) in metrics.meta.items():
+        if kind != "histogram" or not name.endswith("_seconds"):
+            continue
+        series = metrics.values[name].values()
+        count = sum(s[2] for s in series)
+        if count:
+            totals[name] = (sum(s[1] for s in series), count)
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--flyers", type=int, default=2, help="volantini da elaborare in sequenza")
+    parser.add_argument("--pages", type=int, default=16, help="pagine per volantino")
+    parser.add_argument("--pdf", action="append", default=[], help="PDF reali da usare al posto di quelli sintetici")
+    parser.add_argument("--latency-ms", type=float, default=800, help="latenza media del finto Gemini")
+    parser.add_argument("--jitter-ms", type=float, default=200, help="deviazione standard della latenza")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="frazione di risposte 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After (secondi) delle risposte 429")
+    parser.add_argument("--keys", type=int, choices=(1, 2), default=2, help="numero di chiavi API simulate")
+    parser.add_argument("--rpm", type=int, default=1000, help="GEMINI_RPM_PER_KEY usato dallo scheduler")
+    parser.add_argument("--page-concurrency", type=int, default=0, help="GEMINI_PAGE_CONCURRENCY (0 = automatico)")
+    parser.add_argument("--batch-pages", type=int, default=1, help="GEMINI_BATCH_PAGES (pagine per chiamata)")
+    parser.add_argument("--batch-output-tokens", type=int, default=32768, help="GEMINI_BATCH_OUTPUT_TOKENS")
+    parser.add_argument("--raster-processes", type=int, default=0, help="RASTER_PROCESSES")
+    parser.add_argument("--results", default=os.path.join(REPO_DIR, "gemini_results_*.json"), help="risposte simulate")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="scrive anche il report in questo file JSON")
+    parser.add_argument("--keep", action="store_true", help="non cancellare la cartella di lavoro (PDF, immagini, risultati)")
+    args = parser.parse_args()
+    # Percorsi risolti prima di spostarsi nella cartella di lavoro
+    args.pdf = [os.path.abspath(p) for p in args.pdf]
+    args.json = os.path.abspath(args.json) if args.json else None
+
+    # Tutto lo stato di deco (cache, catalogo, immagini, risultati) finisce in una cartella temporanea,
+    # rimossa a fine run salvo --keep
+    workdir = tempfile.mkdtemp(prefix="deco_bench_")
+    cwd = os.getcwd()
+    try:
+        run_benchmark(args, workdir)
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_benchmark(args, workdir):
+    canned = load_canned_pages(args.results)
+    fake = FakeGemini(canned, args.latency_ms, args.jitter_ms, args.rate_429, args.retry_after, args.seed).start()
+
+    os.environ.update({
+        "GEMINI_API_BASE": fake.base_url,
+        "GEMINI_API_KEY": "bench-key-0001",
+        "GEMINI_RPM_PER_KEY": str(args.rpm),
+        "GEMINI_TPM_PER_KEY": str(10 ** 9),
+        "GEMINI_PAGE_CONCURRENCY": str(args.page_concurrency),
+        "GEMINI_CACHE_ENABLED": "0",
+        "FLYER_STATE_ENABLED": "0",
+        "GEMINI_BATCH_PAGES": str(args.batch_pages),
+        "GEMINI_BATCH_OUTPUT_TOKENS": str(args.batch_output_tokens),
+        "RASTER_PROCESSES": str(args.raster_processes),
+        "DISK_PATH": workdir,
+        "RESULTS_CATALOG_PATH": os.path.join(workdir, "results_catalog.sqlite3"),
+    })
+    if args.keys == 2:
+        os.environ["GEMINI_API_KEY_2"] = "bench-key-0002"
+    else:
+        os.environ.pop("GEMINI_API_KEY_2", None)
+    os.environ.pop("DATABASE_URL", None)
+    sys.path.insert(0, REPO_DIR)
+    os.chdir(workdir)
+
+    import logging
+    logging.disable(logging.WARNING)
+    import deco
+
+    pdfs = list(args.pdf)
+    if not pdfs:
+        for i in range(args.flyers):
+            path = os.path.join(workdir, f"flyer_{i + 1}.pdf")
+            make_flyer_pdf(path, args.pages, args.seed + i)
+            pdfs.append(path)
+
+    page_latencies = []
+    analyze_latencies = []
+    lock = threading.Lock()
+
+    class TimedExtractor(deco.MultiAIExtractor):
+        """Misura per pagina il tempo dal rendering alla raccolta e la durata dell'analisi (singola o batch)."""
+
+        def iter_pdf_pages(self, pdf_path, pages=None):
+            for page_number, jpeg in super().iter_pdf_pages(pdf_path, pages):
+                self.rendered_at[page_number] = time.perf_counter()
+                yield page_number, jpeg
+
+        def analyze_with_gemini(self, image_data, retry_count=3, use_cache=True):
+            start = time.perf_counter()
+            try:
+                return super().analyze_with_gemini(image_data, retry_count, use_cache)
+            finally:
+                with lock:
+                    analyze_latencies.append(time.perf_counter() - start)
+
+        def analyze_pages_with_gemini(self, images, retry_count=3, use_cache=True):
+            # In modalità batch ogni pagina del gruppo attende l'intera analisi del gruppo
+            start = time.perf_counter()
+            try:
+                return super().analyze_pages_with_gemini(images, retry_count, use_cache)
+            finally:
+                with lock:
+                    analyze_latencies.extend([time.perf_counter() - start] * len(images))
+
+    def on_page(extractor):
+        def record(page_number, total_pages, products):
+            with lock:
+                page_latencies.append(time.perf_counter() - extractor.rendered_at[page_number])
+        return record
+
+    cpu_start = os.times()
+    wall_start = time.perf_counter()
+    total_pages = total_products = 0
+    # I banner di avanzamento stampati dalla pipeline coprirebbero il report
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for i, pdf in enumerate(pdfs):
+            extractor = TimedExtractor(job_id=f"bench{i + 1}", db_manager=deco.get_db_manager())
+            extractor.rendered_at = {}
+            extractor.on_page = on_page(extractor)
+            total_products += len(extractor.run(pdf, source_type="file"))
+            total_pages += extractor.total_pages or 0
+    wall = time.perf_counter() - wall_start
+    cpu_end = os.times()
+    fake.stop()
+
+    cpu_self = (cpu_end.user - cpu_start.user) + (cpu_end.system - cpu_start.system)
+    cpu_children = (cpu_end.children_user - cpu_start.children_user) + (cpu_end.children_system - cpu_start.children_system)
+    report = {
+        "flyers": len(pdfs),
+        "pages": total_pages,
+        "products": total_products,
+        "wall_seconds": round(wall, 2),
+        "pages_per_minute": round(total_pages / wall * 60, 1) if wall else 0.0,
+        "page_latency_p50": round(percentile(page_latencies, 50), 3),
+        "page_latency_p95": round(percentile(page_latencies, 95), 3),
+        "analyze_latency_p50": round(percentile(analyze_latencies, 50), 3),
+        "analyze_latency_p95": round(percentile(analyze_latencies, 95), 3),
+        "cpu_seconds": round(cpu_self, 2),
+        "cpu_seconds_children": round(cpu_children, 2),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "peak_rss_children_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        "gemini_requests": fake.stats["requests"],
+        "gemini_429": fake.stats["429"],
+        "gemini_batch": deco.gemini_batch_sizer.info() if args.batch_pages > 1 else None,
+        "stages": {name: {"wall_seconds": round(total, 3), "count": count, "mean_ms": round(total / count * 1000, 2)}
+                   for name, (total, count) in stage_totals(deco.metrics).items()},
+        "workdir": workdir if args.keep else None,
+    }
+
+    print("\n📊 Benchmark estrazione")
+    for key, value in report.items():
+        if key != "stages":
+            print(f"  {key:<24} {value}")
+    print("\n⏱️ Tempo reale per fase (wall clock sommato sui thread, non CPU)")
+    for name, stage in report["stages"].items():
+        print(f"  {name:<32} {stage['wall_seconds']:>9.3f}s  n={stage['count']:<6} media {stage['mean_ms']:.2f} ms")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,7 +15,20 @@ import shutil
 import logging
 import base64
 import requests
+from requests.adapters import HTTPAdapter
 import re
+import sqlite3
+import hashlib
+import gzip
+import threading
+import queue
+import bisect
+import uuid
+from contextlib import contextmanager, suppress
+from array import array
+from collections import deque, OrderedDict
+import multiprocessing
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from datetime import datetime
 from io import BytesIO
 from pathlib import Path
@@ -26,15 +39,17 @@ except Exception:
 import cv2
 from PIL import Image
 import fitz # PyMuPDF
+from raster_worker import render_page_jpeg, render_pages
 from bs4 import BeautifulSoup # NUOVO IMPORT per lo scraping
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi import FastAPI, HTTPException, UploadFile, File, Request, Response
 from pydantic import BaseModel
 from typing import Optional, List, Dict, Any
 import uvicorn
 import glob
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import StreamingResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Text, func
+from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Text, Index, func, inspect, text, select, update, tuple_
 from sqlalchemy.orm import sessionmaker, declarative_base
 
 # Configurazione logging
@@ -80,6 +95,131 @@ if DATABASE_URL:
         logger.error(f"❌ Errore configurazione DB: {e}")
         DB_ENABLED = False
 
+# Client HTTP condiviso (Gemini, download PDF, scraping): connessioni keep-alive riutilizzate tra richieste e thread
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "10"))  # host distinti tenuti in pool
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "32"))  # connessioni aperte per host
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+
+class PooledHTTPSession(requests.Session):
+    """Session requests con pool di connessioni per host e timeout (connect, read) di default."""
+    def __init__(self, pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE,
+                 timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)):
+        super().__init__()
+        self.default_timeout = timeout
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.default_timeout)
+        return super().request(method, url, **kwargs)
+
+http_session = PooledHTTPSession()
+
+# Metriche in formato testo Prometheus, esposte su /metrics
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class MetricsRegistry:
+    """Registro minimale di contatori, gauge e istogrammi con etichette, senza dipendenze esterne."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.meta = {}    # nome -> (tipo, descrizione, bucket)
+        self.values = {}  # nome -> {etichette: valore | [conteggi per bucket, somma, conteggio]}
+
+    def _register(self, name, kind, help_text, buckets=None):
+        self.meta[name] = (kind, help_text, buckets)
+        self.values[name] = {}
+
+    def counter(self, name, help_text):
+        self._register(name, "counter", help_text)
+
+    def gauge(self, name, help_text):
+        self._register(name, "gauge", help_text)
+
+    def histogram(self, name, help_text, buckets=METRICS_BUCKETS):
+        self._register(name, "histogram", help_text, tuple(buckets))
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values[name]
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        buckets = self.meta[name][2]
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values[name].get(key)
+            if series is None:
+                series = self.values[name][key] = [[0] * len(buckets), 0.0, 0]
+            index = bisect.bisect_left(buckets, value)
+            if index < len(buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def _labels(key, extra=()):
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (kind, help_text, buckets) in self.meta.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in sorted(self.values[name].items()):
+                    if kind != "histogram":
+                        lines.append(f"{name}{self._labels(key)} {value}")
+                        continue
+                    counts, total, count = value
+                    cumulative = 0
+                    for bound, bucket_count in zip(buckets, counts):
+                        cumulative += bucket_count
+                        lines.append(f"{name}_bucket{self._labels(key, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_bucket{self._labels(key, [('le', '+Inf')])} {count}")
+                    lines.append(f"{name}_sum{self._labels(key)} {total}")
+                    lines.append(f"{name}_count{self._labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+metrics.histogram("deco_pdf_download_seconds", "Durata del download dei PDF.")
+metrics.counter("deco_pdf_download_bytes_total", "Byte di PDF scaricati.")
+metrics.counter("deco_pdf_download_total", "Download di PDF per esito (ok, not_modified, error).")
+metrics.histogram("deco_raster_page_seconds", "Rasterizzazione di una pagina in JPEG (pool: tempo medio per pagina del blocco).")
+metrics.histogram("deco_encode_seconds", "Codifica base64 della pagina per Gemini.")
+metrics.histogram("deco_gemini_request_seconds", "Latenza delle chiamate Gemini per chiave (key0, key1) e codice di stato.")
+metrics.counter("deco_gemini_requests_total", "Chiamate Gemini per chiave (key0, key1) e codice di stato.")
+metrics.counter("deco_gemini_retries_total", "Tentativi ripetuti verso Gemini per motivo.")
+metrics.counter("deco_gemini_json_errors_total", "Risposte Gemini con JSON non valido o troncato.")
+metrics.histogram("deco_gemini_batch_pages", "Pagine inviate in una singola chiamata Gemini batch.", buckets=(2, 3, 4, 6, 8, 12, 16, 24, 32))
+metrics.counter("deco_gemini_batch_splits_total", "Batch Gemini divisi a metà (risposta troncata, prodotti non attribuibili o errore), per motivo.")
+metrics.counter("deco_gemini_cache_total", "Consultazioni della cache Gemini per esito (hit, miss).")
+metrics.gauge("deco_gemini_keys_quarantined", "Chiavi Gemini attualmente in quarantena.")
+metrics.counter("deco_pages_total", "Pagine elaborate per esito (ok, empty, error).")
+metrics.histogram("deco_card_write_seconds", "Generazione e scrittura delle card di una pagina.")
+metrics.counter("deco_cards_written_total", "Card prodotto generate.")
+metrics.histogram("deco_db_ingest_seconds", "Salvataggio nel DB dei prodotti di una pagina.")
+metrics.counter("deco_db_products_total", "Prodotti inviati al DB.")
+metrics.histogram("deco_http_request_seconds", "Latenza delle richieste HTTP servite, per rotta e stato.")
+
 # ==============================================================================
 # 3. CLASSI DI SIMULAZIONE E VARIABILI DI FALLBACK
 # ==============================================================================
@@ -90,79 +230,305 @@ MOONDREAM_AVAILABLE = False
 QWEN_AVAILABLE = False
 logger.warning("⚠️ I fallback Moondream e Qwen sono disabilitati in questo ambiente Colab.")
 
+# Varianti immagine generate su richiesta (larghezze ammesse) e cache LRU in memoria
+IMAGE_VARIANT_WIDTHS = sorted(int(w) for w in os.getenv("IMAGE_VARIANT_WIDTHS", "160,320,480,600").split(",") if w.strip())
+IMAGE_VARIANT_CACHE_MB = float(os.getenv("IMAGE_VARIANT_CACHE_MB", "64"))
+IMAGE_FORMATS = {"jpg": ("JPEG", "image/jpeg"), "jpeg": ("JPEG", "image/jpeg"), "webp": ("WEBP", "image/webp")}
+
+class ImageStore:
+    """Archivio immagini indirizzato per contenuto.
+
+    Ogni immagine è salvata una sola volta come cas/<aa>/<sha256>.jpg sotto la cartella immagini:
+    card identiche di job diversi condividono lo stesso file. Le varianti (larghezza, WebP) vengono
+    generate su richiesta e tenute in una cache LRU in memoria limitata a IMAGE_VARIANT_CACHE_MB.
+    """
+    SUBDIR = "cas"
+    DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+
+    def __init__(self, root, variant_cache_mb=IMAGE_VARIANT_CACHE_MB):
+        self.root = Path(root)
+        self.max_variant_bytes = int(variant_cache_mb * 1024 * 1024)
+        self.lock = threading.Lock()
+        self.variants = OrderedDict()
+        self.variant_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def path_for(self, digest):
+        return self.root / self.SUBDIR / digest[:2] / f"{digest}.jpg"
+
+    def put(self, data):
+        """Salva i byte JPEG (se non già presenti) e restituisce il percorso del file."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path_for(digest)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Scrittura atomica: nessun lettore vede mai un file a metà
+            tmp = path.with_name(f"{path.name}.{os.getpid()}.{uuid.uuid4().hex}.tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+        return str(path)
+
+    def exists(self, digest):
+        return bool(self.DIGEST_RE.match(digest)) and self.path_for(digest).exists()
+
+    def variant(self, digest, width=None, fmt="jpg"):
+        """Byte dell'immagine `digest` larga al massimo `width` nel formato `fmt`, o None se non esiste."""
+        # Controllo sull'originale anche con la variante in cache: un'immagine rimossa non viene più servita
+        if not self.exists(digest):
+            return None
+        key = (digest, width, fmt)
+        with self.lock:
+            data = self.variants.get(key)
+            if data is not None:
+                self.variants.move_to_end(key)
+                self.stats["hits"] += 1
+                return data
+            self.stats["misses"] += 1
+        source = self.path_for(digest)
+        pil_format = IMAGE_FORMATS[fmt][0]
+        if width is None and pil_format == "JPEG":
+            data = source.read_bytes()
+        else:
+            with Image.open(source) as img:
+                img = img.convert("RGB")
+                if width is not None and img.width > width:
+                    img = img.resize((width, max(1, round(img.height * width / img.width))), Image.Resampling.LANCZOS)
+                buffer = BytesIO()
+                img.save(buffer, pil_format, quality=80 if pil_format == "WEBP" else 85)
+                data = buffer.getvalue()
+        with self.lock:
+            if key not in self.variants and len(data) <= self.max_variant_bytes:
+                self.variants[key] = data
+                self.variant_bytes += len(data)
+                while self.variant_bytes > self.max_variant_bytes:
+                    _, evicted = self.variants.popitem(last=False)
+                    self.variant_bytes -= len(evicted)
+                    self.stats["evictions"] += 1
+        return data
+
+    def info(self):
+        with self.lock:
+            return {**self.stats, "variants": len(self.variants), "variant_bytes": self.variant_bytes,
+                    "max_variant_bytes": self.max_variant_bytes, "widths": IMAGE_VARIANT_WIDTHS}
+
 class ProductCardGenerator:
-    """Simula la creazione di una card prodotto, salvando l'immagine originale ridimensionata."""
-    def save_product_card(self, product_info, original_image_path, output_dir, image_name, region_id, supermercato_nome):
-        # Pulizia del nome del prodotto per il filename
-        product_name_clean = re.sub(r'[^\w\s-]', '', product_info.get('nome', 'prodotto')).strip()
-        product_name_clean = re.sub(r'[-\s]+', '_', product_name_clean)[:30]
-        filename = f"{image_name}_{product_name_clean}_card_{region_id}.jpg"
-        filepath = Path(output_dir) / filename
+    """Crea le card prodotto ritagliando i riquadri indicati da Gemini dalla pagina del volantino."""
+    CARD_SIZE = (600, 400)
+    # Margine attorno al riquadro, in frazione della dimensione del riquadro
+    CROP_PADDING = 0.04
+
+    @classmethod
+    def bbox_to_pixels(cls, box_2d, width, height):
+        """Converte un box Gemini [ymin, xmin, ymax, xmax] normalizzato 0-1000 in coordinate pixel (left, top, right, bottom)."""
+        try:
+            ymin, xmin, ymax, xmax = [float(v) for v in box_2d]
+        except (TypeError, ValueError):
+            return None
+        if ymax <= ymin or xmax <= xmin:
+            return None
+        pad_y = (ymax - ymin) * cls.CROP_PADDING
+        pad_x = (xmax - xmin) * cls.CROP_PADDING
+        left = max(0, int((xmin - pad_x) * width / 1000))
+        top = max(0, int((ymin - pad_y) * height / 1000))
+        right = min(width, int(round((xmax + pad_x) * width / 1000)))
+        bottom = min(height, int(round((ymax + pad_y) * height / 1000)))
+        if right - left < 8 or bottom - top < 8:
+            return None
+        return left, top, right, bottom
+
+    def save_product_cards(self, products, page_image, image_store):
+        """Decodifica la pagina una sola volta e ne ritaglia una card per prodotto, salvata in `image_store`.
 
+        `page_image` può essere un percorso o i byte JPEG della pagina. Restituisce i percorsi
+        delle card (None dove la generazione non è riuscita), nello stesso ordine di `products`.
+        """
         try:
-            with Image.open(original_image_path) as img:
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-                img.thumbnail((600, 400), Image.Resampling.LANCZOS)
-                img.save(filepath, 'JPEG', quality=85)
-            return str(filepath)
+            source = BytesIO(page_image) if isinstance(page_image, bytes) else page_image
+            with Image.open(source) as img:
+                page = img.convert('RGB') if img.mode != 'RGB' else img.copy()
         except Exception as e:
-            logger.warning(f"⚠️ Errore simulazione card: {e}")
-            return None
+            logger.warning(f"⚠️ Errore decodifica pagina per le card: {e}")
+            return [None] * len(products)
+
+        # Fallback senza riquadro: miniatura dell'intera pagina, calcolata una sola volta
+        whole_page_card = None
+        encoded = []
+        for prod_index, product_info in enumerate(products, start=1):
+            try:
+                box = self.bbox_to_pixels(product_info.get('box_2d'), page.width, page.height)
+                if box is not None:
+                    card = page.crop(box)
+                    card.thumbnail(self.CARD_SIZE, Image.Resampling.LANCZOS)
+                else:
+                    if whole_page_card is None:
+                        whole_page_card = page.copy()
+                        whole_page_card.thumbnail(self.CARD_SIZE, Image.Resampling.LANCZOS)
+                    card = whole_page_card
+                buffer = BytesIO()
+                card.save(buffer, 'JPEG', quality=85)
+                encoded.append(buffer.getvalue())
+            except Exception as e:
+                logger.warning(f"⚠️ Errore creazione card: {e}")
+                encoded.append(None)
+
+        # Scrittura in blocco delle card della pagina (le card già presenti nell'archivio non vengono riscritte)
+        paths = []
+        for data in encoded:
+            if data is None:
+                paths.append(None)
+                continue
+            try:
+                paths.append(image_store.put(data))
+            except Exception as e:
+                logger.warning(f"⚠️ Errore salvataggio card: {e}")
+                paths.append(None)
+        return paths
+
+def normalize_text(s):
+    """Normalizzazione usata per il controllo duplicati (spazi esterni rimossi, minuscolo)."""
+    if s is None:
+        return ""
+    return str(s).strip().lower()
+
+def product_norm_key(supermercato, nome):
+    """Chiave di deduplica prodotto: hash di (supermercato, nome) normalizzati."""
+    raw = f"{normalize_text(supermercato)}\x1f{normalize_text(nome)}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+SEARCH_FIELDS = ("nome", "marca", "categoria", "descrizione")
+
+def product_search_text(product):
+    """Testo su cui lavorano gli indici di ricerca: campi testuali normalizzati e concatenati."""
+    return " ".join(t for t in (normalize_text(product.get(f)) for f in SEARCH_FIELDS) if t)
+
+def _trigrams(word):
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def fuzzy_match_score(query, search_text):
+    """Punteggio di pertinenza per la modalità senza DB, in stile pg_trgm.
+
+    1.0 se la query compare come sottostringa; altrimenti la media, per ogni parola della query,
+    della miglior similarità a trigrammi con le parole del testo (tollera refusi come "mozarella").
+    """
+    query = normalize_text(query)
+    if not query:
+        return 0.0
+    if query in search_text:
+        return 1.0
+    words = search_text.split()
+    if not words:
+        return 0.0
+    total = 0.0
+    for q_word in query.split():
+        q_tri = _trigrams(q_word)
+        total += max(len(q_tri & _trigrams(w)) / len(q_tri | _trigrams(w)) for w in words)
+    return total / len(query.split())
+
+FUZZY_MATCH_THRESHOLD = float(os.getenv("FUZZY_MATCH_THRESHOLD", "0.6"))
+
+# Retention del simulatore: vengono conservati solo i prodotti degli ultimi SIMULATOR_MAX_JOBS job (0 = nessun limite)
+SIMULATOR_MAX_JOBS = int(os.getenv("SIMULATOR_MAX_JOBS", "50"))
 
 class DBManagerSimulator:
-    """Simula l'interazione con un database."""
-    def __init__(self):
+    """Simula l'interazione con un database.
+
+    Mantiene un indice hash su (supermercato, nome) normalizzati per il controllo duplicati in O(1)
+    e, se `store_path` (o SIMULATOR_STORE_PATH) è impostato, persiste i prodotti in un file JSON Lines
+    ricaricato all'avvio. Oltre `max_jobs` job i più vecchi vengono rimossi e il file viene compattato.
+    """
+    def __init__(self, store_path=None, max_jobs=SIMULATOR_MAX_JOBS):
         print("ℹ️ DBManagerSimulator inizializzato. I prodotti NON saranno salvati in un vero DB.")
         self.products = {}
+        self.index = {}
+        self.max_jobs = max_jobs
+        self.lock = threading.Lock()
+        self.store_path = store_path or os.getenv("SIMULATOR_STORE_PATH")
+        if self.store_path:
+            self._load_store()
+            if self._evict():
+                self._rewrite_store()
 
-    def save_products(self, job_id, products_list):
-        if job_id not in self.products:
-            self.products[job_id] = []
-
-        def norm(s):
-            if s is None:
-                return ""
-            return str(s).strip().lower()
+    @staticmethod
+    def _key(product):
+        return (normalize_text(product.get("supermercato")), normalize_text(product.get("nome")))
+
+    def _add(self, job_id, product):
+        items = self.products.setdefault(job_id, [])
+        product['db_id'] = len(items) + 1
+        items.append(product)
+        self.index[self._key(product)] = (job_id, product['db_id'])
+
+    def _load_store(self):
+        path = Path(self.store_path)
+        if not path.exists():
+            return
+        loaded = 0
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # riga troncata da un arresto improvviso
+                product = record.get("product") or {}
+                if self._key(product) not in self.index:
+                    self._add(record.get("job_id"), product)
+                    loaded += 1
+        logger.info(f"💾 DBManagerSimulator: caricati {loaded} prodotti da {path}")
+
+    def _evict(self):
+        """Rimuove i job più vecchi (ordine di arrivo) oltre `max_jobs`; restituisce il numero di job rimossi."""
+        if self.max_jobs <= 0:
+            return 0
+        evicted = 0
+        while len(self.products) > self.max_jobs:
+            job_id = next(iter(self.products))
+            for product in self.products.pop(job_id):
+                key = self._key(product)
+                if self.index.get(key, (None,))[0] == job_id:
+                    del self.index[key]
+            evicted += 1
+        if evicted:
+            logger.info(f"🧹 DBManagerSimulator: rimossi {evicted} job oltre il limite di {self.max_jobs}.")
+        return evicted
+
+    def _rewrite_store(self):
+        # Compattazione: riscrive il file con i soli prodotti conservati (sostituzione atomica)
+        tmp_path = f"{self.store_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for job_id, items in self.products.items():
+                for product in items:
+                    f.write(json.dumps({"job_id": job_id, "product": product}, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.store_path)
 
+    def save_products(self, job_id, products_list):
         saved = []
-        for product in products_list:
-            sup = norm(product.get("supermercato"))
-            nome = norm(product.get("nome"))
-
-        
-            # Controllo duplicati: stesso supermercato e stesso nome prodotto
-            exists = False
-            for existing in self.products[job_id]:
-                if norm(existing.get("supermercato")) == sup and norm(existing.get("nome")) == nome:
-                    exists = True
-                    break
-
-            # Controllo anche tra tutti i job (evita duplicati globali quando DB non attivo)
-            if not exists:
-                for other_job, items in self.products.items():
-                    if other_job == job_id:
-                        continue
-                    for existing in items:
-                        if norm(existing.get("supermercato")) == sup and norm(existing.get("nome")) == nome:
-                            exists = True
-                            break
-                    if exists:
-                        break
-
-            if exists:
-                continue
-
-            product['db_id'] = len(self.products[job_id]) + 1
-            self.products[job_id].append(product)
-            saved.append(product)
-
+        with self.lock:
+            for product in products_list:
+                # Controllo duplicati (anche tra job diversi): stesso supermercato e stesso nome prodotto
+                key = self._key(product)
+                if key in self.index:
+                    continue
+                self._add(job_id, product)
+                saved.append(product)
+
+            evicted = self._evict() if saved else 0
+            if evicted and self.store_path:
+                self._rewrite_store()
+            elif saved and self.store_path:
+                with open(self.store_path, "a", encoding="utf-8") as f:
+                    for product in saved:
+                        f.write(json.dumps({"job_id": job_id, "product": product}, ensure_ascii=False) + "\n")
         return saved
 
     def update_job_status(self, job_id, status, progress, total_products, message):
         print(f"📊 Simulazione Aggiornamento Job {job_id}: Stato={status}, Progresso={progress}%, Prodotti={total_products}")
+        job_manager.update(job_id, status, progress, total_products, message)
         return True
 
+# Estensione pg_trgm presente (rilevata all'avvio): abilita i predicati a trigrammi in /search
+PG_TRGM_AVAILABLE = False
+
 # Modello SQLAlchemy (se DB attivo)
 if DB_ENABLED and Base is not None:
     class Product(Base):
@@ -182,9 +548,68 @@ if DB_ENABLED and Base is not None:
         volantino_name = Column(Text)
         volantino_validita = Column(Text)
         created_at = Column(DateTime, default=datetime.utcnow, index=True)
+        # Hash di (supermercato, nome) normalizzati: indice univoco per la deduplica in blocco
+        norm_key = Column(String(40), unique=True, index=True)
+        # Testo di ricerca normalizzato (nome, marca, categoria, descrizione), mantenuto all'ingest
+        search_text = Column(Text)
+
+        # Paginazione keyset su (created_at, id)
+        __table_args__ = (Index("ix_products_created_at_id", "created_at", "id"),)
+
+    def _migrate_products_table():
+        """Aggiunge e popola norm_key/search_text su tabelle create prima dell'introduzione delle colonne."""
+        columns = {c["name"] for c in inspect(engine).get_columns("products")}
+        for name, ddl_type in (("norm_key", "VARCHAR(40)"), ("search_text", "TEXT")):
+            if name not in columns:
+                with engine.begin() as conn:
+                    conn.execute(text(f"ALTER TABLE products ADD COLUMN {name} {ddl_type}"))
+                print(f"✅ Colonna products.{name} aggiunta.")
+        session = SessionLocal()
+        try:
+            rows = session.execute(
+                select(Product.id, Product.supermercato, Product.nome, Product.marca, Product.categoria, Product.descrizione, Product.norm_key)
+                .where((Product.norm_key.is_(None)) | (Product.search_text.is_(None))).order_by(Product.id)
+            ).all()
+            if rows:
+                taken = set(session.execute(select(Product.norm_key).where(Product.norm_key.is_not(None))).scalars())
+                updates = []
+                for row in rows:
+                    values = {"id": row.id, "search_text": product_search_text(row._mapping)}
+                    if row.norm_key is None:
+                        key = product_norm_key(row.supermercato, row.nome)
+                        # Eventuali duplicati storici restano con norm_key NULL (non violano l'indice univoco)
+                        if key not in taken:
+                            taken.add(key)
+                            values["norm_key"] = key
+                    updates.append(values)
+                session.execute(update(Product), updates)
+                session.commit()
+                print(f"✅ norm_key/search_text popolati per {len(updates)} prodotti.")
+        finally:
+            session.close()
+        with engine.begin() as conn:
+            conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_products_norm_key ON products (norm_key)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_products_created_at_id ON products (created_at, id)"))
+        if engine.dialect.name == "postgresql":
+            global PG_TRGM_AVAILABLE
+            # Full-text (configurazione italiana): non richiede estensioni
+            with engine.begin() as conn:
+                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_products_search_fts ON products USING gin (to_tsvector('italian', coalesce(search_text, '')))"))
+            # Trigrammi per sottostringhe e refusi: solo se pg_trgm e' installabile
+            try:
+                with engine.begin() as conn:
+                    conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_products_search_trgm ON products USING gin (search_text gin_trgm_ops)"))
+            except Exception as e:
+                logger.warning(f"⚠️ Indice trigrammi non creato (pg_trgm non disponibile?): {e}")
+            with engine.connect() as conn:
+                PG_TRGM_AVAILABLE = conn.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).first() is not None
+            if not PG_TRGM_AVAILABLE:
+                logger.warning("⚠️ pg_trgm assente: /search usa solo full-text e ILIKE")
 
     try:
         Base.metadata.create_all(bind=engine)
+        _migrate_products_table()
         print("✅ Tabelle DB create/verificate.")
     except Exception as e:
         logger.error(f"❌ Errore creazione tabelle: {e}")
@@ -213,53 +638,88 @@ class DBManagerSQLAlchemy:
         except ValueError:
             return 0.0
 
+    # Righe per singola istruzione INSERT multi-VALUES (sotto il limite di parametri di Postgres)
+    INSERT_BATCH_SIZE = 1000
+
+    def _product_row(self, job_id, p, norm_key, created_at):
+        return {
+            "job_id": job_id,
+            "nome": p.get("nome"),
+            "marca": p.get("marca"),
+            "categoria": p.get("categoria"),
+            "prezzo": p.get("prezzo"),
+            "prezzo_float": self._convert_price_to_float(p.get("prezzo")),
+            "descrizione": p.get("descrizione"),
+            "pagina": p.get("pagina"),
+            "supermercato": p.get("supermercato"),
+            "immagine_prodotto_card": p.get("immagine_prodotto_card"),
+            "volantino_url": p.get("volantino_url"),
+            "volantino_name": p.get("volantino_name"),
+            "volantino_validita": p.get("volantino_validita"),
+            "created_at": created_at,
+            "norm_key": norm_key,
+            "search_text": product_search_text(p),
+        }
+
+    @staticmethod
+    def _insert_ignore_duplicates():
+        """INSERT ... ON CONFLICT (norm_key) DO NOTHING per i dialetti che lo supportano, altrimenti None."""
+        dialect = engine.dialect.name
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        elif dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            return None
+        return dialect_insert(Product)
+
     def save_products(self, job_id, products_list):
+        """Salva in blocco una lista di prodotti saltando i duplicati (stesso supermercato e nome).
+
+        I prodotti inseriti ricevono `db_id` e vengono restituiti nell'ordine di input.
+        """
         if not DB_ENABLED or SessionLocal is None or Base is None:
             return products_list
         session = self.SessionLocal()
         saved = []
         try:
-            def norm(s):
-                if s is None:
-                    return ""
-                return str(s).strip().lower()
+            # Deduplica all'interno del batch: vale il primo prodotto con una data chiave
+            by_key = {}
             for p in products_list:
-                sup = norm(p.get("supermercato"))
-                nome = norm(p.get("nome"))
-                marca_norm = norm(p.get("marca"))
-
-                existing = session.query(Product).filter(
-                    func.lower(func.trim(Product.supermercato)) == sup,
-                    func.lower(func.trim(Product.nome)) == nome,
-                ).first()
-
-                if existing:
-                    # Skip duplicate: stesso supermercato e stesso prodotto
-                    continue
-
-                obj = Product(
-                    job_id=job_id,
-                    nome=p.get("nome"),
-                    marca=p.get("marca"),
-                    categoria=p.get("categoria"),
-                    prezzo=p.get("prezzo"),
-                    prezzo_float=self._convert_price_to_float(p.get("prezzo")),
-                    descrizione=p.get("descrizione"),
-                    pagina=p.get("pagina"),
-                    supermercato=p.get("supermercato"),
-                    immagine_prodotto_card=p.get("immagine_prodotto_card"),
-                    volantino_url=p.get("volantino_url"),
-                    volantino_name=p.get("volantino_name"),
-                    volantino_validita=p.get("volantino_validita"),
-                )
-                session.add(obj)
-                session.flush()
-                p["db_id"] = obj.id
-                saved.append(p)
+                by_key.setdefault(product_norm_key(p.get("supermercato"), p.get("nome")), p)
+            created_at = datetime.utcnow()
+            rows = [self._product_row(job_id, p, key, created_at) for key, p in by_key.items()]
+
+            inserted_ids = {}
+            insert_stmt = self._insert_ignore_duplicates()
+            for start in range(0, len(rows), self.INSERT_BATCH_SIZE):
+                chunk = rows[start:start + self.INSERT_BATCH_SIZE]
+                if insert_stmt is not None:
+                    stmt = insert_stmt.values(chunk).on_conflict_do_nothing(index_elements=["norm_key"]).returning(Product.id, Product.norm_key)
+                    for row_id, key in session.execute(stmt):
+                        inserted_ids[key] = row_id
+                else:
+                    existing = set(session.execute(
+                        select(Product.norm_key).where(Product.norm_key.in_([r["norm_key"] for r in chunk]))
+                    ).scalars())
+                    for r in chunk:
+                        if r["norm_key"] in existing:
+                            continue
+                        obj = Product(**r)
+                        session.add(obj)
+                        session.flush()
+                        inserted_ids[r["norm_key"]] = obj.id
             session.commit()
+            offer_index.mark_stale()
+
+            for key, p in by_key.items():
+                if key in inserted_ids:
+                    p["db_id"] = inserted_ids[key]
+                    saved.append(p)
         except Exception as e:
             session.rollback()
             logger.error(f"❌ Errore salvataggio prodotti nel DB: {e}")
+            saved = []
         finally:
             session.close()
         return saved
@@ -267,12 +727,152 @@ class DBManagerSQLAlchemy:
     def update_job_status(self, job_id, status, progress, total_products, message):
         # Puoi persistere lo stato dei job in una tabella dedicata se necessario
         print(f"📊 Job {job_id}: Stato={status}, Progresso={progress}%, Prodotti={total_products} - {message}")
+        job_manager.update(job_id, status, progress, total_products, message)
         return True
 
+_simulator = None
+_simulator_lock = threading.Lock()
+
 def get_db_manager():
+    global _simulator
     if DB_ENABLED and SessionLocal is not None:
         return DBManagerSQLAlchemy(SessionLocal)
-    return DBManagerSimulator()
+    # Il simulatore è condiviso nel processo, così la deduplica vale tra job e richieste diverse
+    with _simulator_lock:
+        if _simulator is None:
+            _simulator = DBManagerSimulator()
+        return _simulator
+
+# ------------------------------------------------------------------------------
+# GESTIONE JOB IN BACKGROUND
+# ------------------------------------------------------------------------------
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_QUEUE_LIMIT = int(os.getenv("JOB_QUEUE_LIMIT", "20"))
+JOB_HISTORY_LIMIT = int(os.getenv("JOB_HISTORY_LIMIT", "200"))
+
+def new_job_id(prefix=""):
+    """Id univoco del job: timestamp in millisecondi (leggibile e ordinabile) più un suffisso casuale,
+    così due richieste nello stesso millisecondo non si sovrascrivono."""
+    return f"{prefix}{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}"
+
+class JobQueueFullError(Exception):
+    """Sollevata quando la coda dei job ha raggiunto JOB_QUEUE_LIMIT."""
+
+class JobManager:
+    """Esegue i job di estrazione su un pool di thread limitato e ne conserva lo stato in memoria."""
+    TERMINAL_STATUSES = ("completed", "failed", "cancelled")
+
+    def __init__(self, max_workers=JOB_WORKERS, queue_limit=JOB_QUEUE_LIMIT, history_limit=JOB_HISTORY_LIMIT):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self.queue_limit = queue_limit
+        self.history_limit = history_limit
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _now():
+        return datetime.now().isoformat()
+
+    def _new_record(self, job_id, kind, params=None, parent_id=None):
+        now = self._now()
+        return {
+            "job_id": job_id,
+            "kind": kind,
+            "parent_id": parent_id,
+            "status": "queued",
+            "progress": 0,
+            "total_products": 0,
+            "message": "In coda.",
+            "params": params or {},
+            "created_at": now,
+            "updated_at": now,
+            "result": None,
+            "error": None,
+        }
+
+    def _prune(self):
+        # Mantiene solo gli ultimi JOB_HISTORY_LIMIT job terminati
+        finished = [j for j in self.jobs.values() if j["status"] in self.TERMINAL_STATUSES]
+        excess = len(finished) - self.history_limit
+        if excess > 0:
+            finished.sort(key=lambda j: j["updated_at"])
+            for j in finished[:excess]:
+                self.jobs.pop(j["job_id"], None)
+
+    def submit(self, job_id, kind, func, params=None):
+        """Accoda un job. `func()` deve restituire il risultato (dict) da esporre su /jobs/{id}."""
+        with self.lock:
+            pending = sum(1 for j in self.jobs.values() if j["status"] not in self.TERMINAL_STATUSES and j["parent_id"] is None)
+            if pending >= self.queue_limit:
+                raise JobQueueFullError(f"Coda job piena ({pending}/{self.queue_limit}).")
+            record = self._new_record(job_id, kind, params)
+            record["managed"] = True
+            self.jobs[job_id] = record
+            self._prune()
+        self.executor.submit(self._execute, job_id, func)
+        return self.get(job_id)
+
+    def _execute(self, job_id, func):
+        self.update(job_id, "processing", 0, 0, "Job avviato.")
+        try:
+            result = func()
+        except Exception as e:
+            logger.error(f"❌ Job {job_id} fallito: {e}")
+            with self.lock:
+                record = self.jobs.get(job_id)
+                if record:
+                    record.update(status="failed", error=str(e), message=f"Errore fatale: {e}", updated_at=self._now())
+            return
+        with self.lock:
+            record = self.jobs.get(job_id)
+            if not record:
+                return
+            # Lo stato terminale riportato dall'estrattore (es. "failed") prevale su "completed"
+            status = record.pop("reported_status", None) or "completed"
+            # Un job fallito conserva l'avanzamento riportato (es. pagine analizzate prima degli errori)
+            record.update(status=status, progress=100 if status == "completed" else record["progress"], result=result, updated_at=self._now())
+            if isinstance(result, dict) and "total_products" in result:
+                record["total_products"] = result["total_products"]
+            if status == "completed":
+                record["message"] = "Elaborazione completata."
+
+    def update(self, job_id, status, progress, total_products, message, parent_id=None):
+        """Aggiorna lo stato di un job (chiamato anche dai DB manager durante l'estrazione)."""
+        with self.lock:
+            record = self.jobs.get(job_id)
+            if record is None:
+                record = self._new_record(job_id, "flyer" if parent_id else "extract", parent_id=parent_id)
+                self.jobs[job_id] = record
+            if record.get("managed") and status in self.TERMINAL_STATUSES:
+                # Il job gestito diventa terminale solo quando la funzione del worker ha restituito il risultato
+                record["reported_status"] = status
+                status = "processing"
+            record.update(status=status, progress=progress, total_products=total_products, message=message, updated_at=self._now())
+            self._prune()
+
+    def get(self, job_id, include_result=True):
+        with self.lock:
+            record = self.jobs.get(job_id)
+            if record is None:
+                return None
+            data = {k: v for k, v in record.items() if k not in ("managed", "reported_status")}
+            children = [self.get_summary(j) for j in self.jobs.values() if j["parent_id"] == job_id]
+        if children:
+            data["children"] = children
+        if not include_result:
+            data.pop("result", None)
+        return data
+
+    def list(self):
+        with self.lock:
+            jobs = [self.get_summary(j) for j in self.jobs.values()]
+        return sorted(jobs, key=lambda j: j["created_at"], reverse=True)
+
+    @staticmethod
+    def get_summary(record):
+        return {k: record[k] for k in ("job_id", "kind", "parent_id", "status", "progress", "total_products", "message", "created_at", "updated_at")}
+
+job_manager = JobManager()
 
 # ------------------------------------------------------------------------------
 # NUOVA SEZIONE: SCRAPER PER VOLANTINI DECO
@@ -286,13 +886,27 @@ class DecoFlyerScraper:
     def __init__(self):
         logger.info(f"🌐 Inizializzazione Scraper per {self.TARGET_URL}")
 
-    def scrape_flyers(self):
-        """Esegue lo scraping della pagina e restituisce una lista di dizionari."""
+    def scrape_flyers(self, force=False):
+        """Esegue lo scraping della pagina e restituisce una lista di dizionari.
+
+        Con lo stato dei crawl abilitato la pagina indice viene richiesta in modo condizionale:
+        se non è cambiata (304 o stesso hash) viene restituito l'elenco salvato. `force` ignora lo stato.
+        """
         flyers = []
         try:
             headers = {'User-Agent': 'Mozilla/5.0'}
-            response = requests.get(self.TARGET_URL, headers=headers, timeout=15)
+            state = flyer_state.get(self.TARGET_URL) if flyer_state is not None and not force else None
+            if state:
+                headers.update(FlyerStateStore.conditional_headers(state))
+            response = http_session.get(self.TARGET_URL, headers=headers, timeout=(HTTP_CONNECT_TIMEOUT, 15))
+            if response.status_code == 304 and state and state['payload'] is not None:
+                logger.info("♻️ Pagina volantini invariata (304): uso l'elenco salvato.")
+                return state['payload']
             response.raise_for_status()
+            content_hash = hashlib.sha256(response.content).hexdigest()
+            if state and state['sha256'] == content_hash and state['payload'] is not None:
+                logger.info("♻️ Pagina volantini invariata (stesso contenuto): uso l'elenco salvato.")
+                return state['payload']
             soup = BeautifulSoup(response.content, 'html.parser')
 
             # Ricerca dei contenitori principali dei volantini
@@ -312,6 +926,7 @@ class DecoFlyerScraper:
                      if not pdf_url.startswith('http'):
                          pdf_url = self.BASE_URL + pdf_url
                      flyers.append({'name': pdf_url.split('/')[-1], 'url': pdf_url, 'validity': "Data non disponibile (Fallback)"})
+                 self._remember(response, content_hash, flyers)
                  return flyers
 
             for card in flyer_cards:
@@ -341,6 +956,7 @@ class DecoFlyerScraper:
                 })
 
             logger.info(f"✅ Trovati {len(flyers)} volantini.")
+            self._remember(response, content_hash, flyers)
             return flyers
 
         except requests.exceptions.RequestException as e:
@@ -350,13 +966,675 @@ class DecoFlyerScraper:
             logger.error(f"❌ Errore generico di scraping: {e}")
             return []
 
+    def _remember(self, response, content_hash, flyers):
+        if flyer_state is not None and flyers:
+            flyer_state.put(self.TARGET_URL, etag=response.headers.get('ETag'),
+                            last_modified=response.headers.get('Last-Modified'),
+                            sha256=content_hash, payload=flyers)
+
 # ==============================================================================
 # 4. DEFINIZIONE DELLA CLASSE MULTIAIEXTRACTOR (CON CORREZIONI)
 # ==============================================================================
 print("\n4. Definizione della classe MultiAIExtractor...")
 
+# Limiti di concorrenza e rate limiting per le chiamate Gemini
+GEMINI_RPM_PER_KEY = float(os.getenv("GEMINI_RPM_PER_KEY", "10"))
+GEMINI_TPM_PER_KEY = float(os.getenv("GEMINI_TPM_PER_KEY", "250000"))
+GEMINI_ESTIMATED_TOKENS = int(os.getenv("GEMINI_ESTIMATED_TOKENS", "3000"))  # stima token per chiamata (immagine + risposta)
+GEMINI_QUARANTINE_AFTER = int(os.getenv("GEMINI_QUARANTINE_AFTER", "3"))  # errori 429/5xx consecutivi prima della quarantena
+GEMINI_QUARANTINE_SECONDS = float(os.getenv("GEMINI_QUARANTINE_SECONDS", "60"))
+GEMINI_PAGE_CONCURRENCY = int(os.getenv("GEMINI_PAGE_CONCURRENCY", "0"))  # 0 = automatico (4 per chiave)
+# Endpoint base delle API Gemini (sovrascrivibile per test e benchmark con un server locale)
+GEMINI_API_BASE = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com").rstrip("/")
+# Tetto globale alle chiamate Gemini contemporanee, condiviso da tutti gli estrattori (0 = nessun limite)
+GEMINI_MAX_IN_FLIGHT = int(os.getenv("GEMINI_MAX_IN_FLIGHT", "0"))
+# Batching multi-pagina: fino a GEMINI_BATCH_PAGES immagini per chiamata (1 = una pagina per chiamata)
+GEMINI_BATCH_PAGES = int(os.getenv("GEMINI_BATCH_PAGES", "1"))
+GEMINI_MAX_OUTPUT_TOKENS = int(os.getenv("GEMINI_MAX_OUTPUT_TOKENS", "4096"))  # limite di output per chiamata a pagina singola
+GEMINI_BATCH_OUTPUT_TOKENS = int(os.getenv("GEMINI_BATCH_OUTPUT_TOKENS", "32768"))  # limite di output per chiamata batch
+GEMINI_PAGE_OUTPUT_TOKENS = int(os.getenv("GEMINI_PAGE_OUTPUT_TOKENS", "1500"))  # stima iniziale dei token di output per pagina
+
+class TokenBucket:
+    """Token bucket con ricarica continua: `per_minute` unità al minuto, burst pari a un quarto di minuto."""
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, per_minute / 4.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        self.refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def consume(self, amount):
+        # Può andare in negativo quando il consumo reale supera la stima: le richieste successive attendono
+        self.tokens -= amount
+
+    def headroom(self):
+        return self.tokens / self.capacity
+
+class GeminiKeyScheduler:
+    """Scheduler condiviso tra tutti gli estrattori del processo.
+
+    Tiene un budget RPM/TPM per chiave, instrada ogni chiamata sulla chiave con più margine
+    e mette in quarantena le chiavi che restituiscono ripetutamente 429/5xx (rispettando Retry-After).
+    """
+    def __init__(self, rpm=GEMINI_RPM_PER_KEY, tpm=GEMINI_TPM_PER_KEY, quarantine_after=GEMINI_QUARANTINE_AFTER, quarantine_seconds=GEMINI_QUARANTINE_SECONDS):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.quarantine_after = quarantine_after
+        self.quarantine_seconds = quarantine_seconds
+        self.keys = {}
+        self.cond = threading.Condition()
+
+    def _state(self, api_key):
+        state = self.keys.get(api_key)
+        if state is None:
+            state = {
+                "requests": TokenBucket(self.rpm),
+                "tokens": TokenBucket(self.tpm),
+                "failures": 0,
+                "blocked_until": 0.0,
+                "calls": 0,
+                "errors": 0,
+                "tokens_used": 0,
+                "last_status": None,
+            }
+            self.keys[api_key] = state
+        return state
+
+    def acquire(self, api_keys, estimated_tokens=GEMINI_ESTIMATED_TOKENS):
+        """Blocca finché una delle chiavi ha budget disponibile e restituisce quella con più margine."""
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                best_key, best_headroom, min_wait = None, None, float("inf")
+                for api_key in api_keys:
+                    state = self._state(api_key)
+                    wait = max(
+                        state["blocked_until"] - now,
+                        state["requests"].wait_time(1, now),
+                        state["tokens"].wait_time(estimated_tokens, now),
+                    )
+                    if wait > 0:
+                        min_wait = min(min_wait, wait)
+                        continue
+                    headroom = min(state["requests"].headroom(), state["tokens"].headroom())
+                    if best_headroom is None or headroom > best_headroom:
+                        best_key, best_headroom = api_key, headroom
+                if best_key is not None:
+                    state = self.keys[best_key]
+                    state["requests"].consume(1)
+                    state["tokens"].consume(estimated_tokens)
+                    state["calls"] += 1
+                    return best_key
+                self.cond.wait(timeout=min(min_wait, 5.0))
+
+    def report(self, api_key, status_code, estimated_tokens=GEMINI_ESTIMATED_TOKENS, tokens_used=None, retry_after=None):
+        """Registra l'esito di una chiamata. `status_code=None` indica un errore di rete."""
+        with self.cond:
+            state = self._state(api_key)
+            state["last_status"] = status_code
+            now = time.monotonic()
+            if tokens_used is not None:
+                state["tokens_used"] += tokens_used
+                # Corregge il budget TPM con il consumo reale
+                state["tokens"].consume(tokens_used - estimated_tokens)
+            if status_code is None or status_code == 429 or status_code >= 500:
+                state["failures"] += 1
+                state["errors"] += 1
+                backoff = min(2 ** state["failures"], 30)
+                if state["failures"] >= self.quarantine_after:
+                    backoff = max(backoff, self.quarantine_seconds)
+                    logger.warning(f"🚫 Chiave Gemini ...{api_key[-4:]} in quarantena per {backoff:.0f}s dopo {state['failures']} errori consecutivi.")
+                if retry_after is not None:
+                    backoff = max(backoff, retry_after)
+                state["blocked_until"] = max(state["blocked_until"], now + backoff)
+            else:
+                state["failures"] = 0
+            self.cond.notify_all()
+
+    def status(self):
+        with self.cond:
+            now = time.monotonic()
+            return [{
+                "key": f"...{api_key[-4:]}",
+                "calls": state["calls"],
+                "errors": state["errors"],
+                "tokens_used": state["tokens_used"],
+                "consecutive_failures": state["failures"],
+                "quarantined_for": round(max(0.0, state["blocked_until"] - now), 1),
+                "last_status": state["last_status"],
+            } for api_key, state in self.keys.items()]
+
+class GeminiBatchSizer:
+    """Sceglie quante pagine inviare in una chiamata batch restando entro il limite di token di output.
+
+    Tiene una media mobile dei token di output per pagina osservati nelle risposte (usageMetadata)
+    e la alza quando una risposta viene troncata, così le chiamate successive usano batch più piccoli.
+    """
+    def __init__(self, max_pages=GEMINI_BATCH_PAGES, output_tokens=GEMINI_BATCH_OUTPUT_TOKENS, page_tokens=GEMINI_PAGE_OUTPUT_TOKENS, margin=0.75, alpha=0.3):
+        self.max_pages = max_pages
+        self.output_tokens = output_tokens
+        self.page_tokens = float(page_tokens)
+        self.margin = margin
+        self.alpha = alpha
+        self.lock = threading.Lock()
+
+    def size(self):
+        with self.lock:
+            fit = int(self.output_tokens * self.margin // max(self.page_tokens, 1.0))
+        return max(1, min(self.max_pages, fit))
+
+    def observe(self, output_tokens, pages):
+        if not output_tokens or not pages:
+            return
+        with self.lock:
+            self.page_tokens += self.alpha * (output_tokens / pages - self.page_tokens)
+
+    def truncated(self, pages):
+        # Le pagine del batch producono in media almeno output_tokens / pages token
+        with self.lock:
+            self.page_tokens = max(self.page_tokens, self.output_tokens / max(pages, 1))
+
+    def info(self):
+        with self.lock:
+            page_tokens = self.page_tokens
+        return {"max_pages": self.max_pages, "output_tokens": self.output_tokens,
+                "page_tokens": round(page_tokens), "batch_size": self.size()}
+
+gemini_scheduler = GeminiKeyScheduler()
+gemini_in_flight = threading.BoundedSemaphore(GEMINI_MAX_IN_FLIGHT) if GEMINI_MAX_IN_FLIGHT > 0 else None
+gemini_batch_sizer = GeminiBatchSizer()
+
+class GeminiAnalysisError(Exception):
+    """Analisi di una pagina non riuscita (tentativi esauriti o risposta inutilizzabile): la pagina va ritentata."""
+
+class GeminiRetryableError(GeminiAnalysisError):
+    """Errore temporaneo di una singola chiamata (429, 5xx, rete): la chiamata può essere ripetuta."""
+    def __init__(self, message, reason):
+        super().__init__(message)
+        self.reason = reason
+
+class ExtractionCancelled(Exception):
+    """L'estrazione è stata interrotta dal chiamante (es. client dello stream disconnesso): il job non è fallito."""
+
+def parse_retry_after(response):
+    """Estrae il tempo di attesa suggerito (header Retry-After o RetryInfo nel body di Gemini)."""
+    header = response.headers.get("Retry-After")
+    if header:
+        try:
+            return float(header)
+        except ValueError:
+            pass
+    try:
+        for detail in response.json().get("error", {}).get("details", []):
+            delay = detail.get("retryDelay")
+            if delay:
+                return float(str(delay).rstrip("s"))
+    except Exception:
+        pass
+    return None
+
+GEMINI_PROMPT = """
+Analizza questa immagine di un volantino di supermercato italiano e estrai SOLO le informazioni sui prodotti alimentari visibili.
+
+Rispondi ESCLUSIVAMENTE con un JSON valido. Lo schema JSON richiesto è:
+{
+  "prodotti": [
+    {
+      "nome": "nome completo del prodotto",
+      "marca": "marca del prodotto (es: Barilla, Mulino Bianco, Granarolo)",
+      "categoria": "categoria (latticini, pasta, bevande, dolci, etc.)",
+      "prezzo": "prezzo in euro se visibile (es: 2.49)",
+      "descrizione": "breve descrizione del prodotto",
+      "box_2d": [ymin, xmin, ymax, xmax]
+    }
+  ]
+}
+
+Regole importanti:
+- Il valore del campo "prezzo" DEVE essere una stringa (es: "2.49", "Non visibile").
+- Estrai SOLO prodotti alimentari chiaramente visibili
+- Se non vedi un prezzo, scrivi "Non visibile"
+- Se non riconosci una marca, scrivi "Non identificata"
+- Concentrati sui prodotti più evidenti e leggibili
+- Massimo 10 prodotti per immagine
+- "box_2d" è il riquadro che contiene il prodotto (foto, nome e prezzo), con coordinate intere normalizzate 0-1000 rispetto all'immagine
+"""
+
+# Prompt per le chiamate batch ({n} = pagine nella chiamata): ogni immagine è preceduta da "Immagine k"
+# e ogni prodotto indica in "immagine" da quale pagina proviene
+GEMINI_BATCH_PROMPT = GEMINI_PROMPT.replace(
+    "Analizza questa immagine di un volantino",
+    "Analizza le {n} immagini seguenti, ciascuna preceduta dall'etichetta \"Immagine k\" (k da 1 a {n}), di un volantino",
+).replace(
+    '      "descrizione": "breve descrizione del prodotto",',
+    '      "immagine": "numero k dell\'immagine in cui compare il prodotto (intero da 1 a {n})",\n'
+    '      "descrizione": "breve descrizione del prodotto",',
+).replace(
+    "- Massimo 10 prodotti per immagine",
+    "- Massimo 10 prodotti per immagine\n- Ogni prodotto DEVE avere il campo \"immagine\"; \"box_2d\" si riferisce a quell'immagine",
+)
+
+# Cache persistente dei risultati Gemini (chiave: hash di immagine codificata + prompt + modello)
+GEMINI_CACHE_ENABLED = os.getenv("GEMINI_CACHE_ENABLED", "1") == "1"
+GEMINI_CACHE_TTL_DAYS = float(os.getenv("GEMINI_CACHE_TTL_DAYS", "30"))
+GEMINI_CACHE_MAX_ENTRIES = int(os.getenv("GEMINI_CACHE_MAX_ENTRIES", "20000"))
+
+def _default_state_path(filename):
+    """Percorso per i file di stato locali: sul Persistent Disk se configurato, altrimenti nella cartella corrente."""
+    disk_path = os.getenv("DISK_PATH") or os.getenv("PERSISTENT_DISK_PATH")
+    return str(Path(disk_path) / filename) if disk_path else filename
+
+class GeminiResultCache:
+    """Cache SQLite dei prodotti estratti per pagina, con scadenza TTL, limite di voci (LRU) e contatori hit/miss."""
+    def __init__(self, path=None, ttl_days=GEMINI_CACHE_TTL_DAYS, max_entries=GEMINI_CACHE_MAX_ENTRIES):
+        self.path = path or os.getenv("GEMINI_CACHE_PATH") or _default_state_path("gemini_cache.sqlite3")
+        self.ttl = ttl_days * 86400
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS gemini_cache ("
+            "key TEXT PRIMARY KEY, prodotti TEXT NOT NULL, created REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ix_gemini_cache_last_access ON gemini_cache(last_access)")
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(image_base64, prompt, model_name):
+        h = hashlib.sha256()
+        for part in (model_name, prompt, image_base64):
+            h.update(part.encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT prodotti, created FROM gemini_cache WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.ttl > 0 and now - row[1] > self.ttl):
+                self.stats["misses"] += 1
+                return None
+            self.conn.execute("UPDATE gemini_cache SET last_access = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            self.stats["hits"] += 1
+        return json.loads(row[0])
+
+    def put(self, key, prodotti):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO gemini_cache (key, prodotti, created, last_access) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(prodotti, ensure_ascii=False), now, now),
+            )
+            self.stats["writes"] += 1
+            self._evict(now)
+            self.conn.commit()
+
+    def _evict(self, now):
+        evicted = 0
+        if self.ttl > 0:
+            evicted += self.conn.execute("DELETE FROM gemini_cache WHERE created < ?", (now - self.ttl,)).rowcount
+        count = self.conn.execute("SELECT COUNT(*) FROM gemini_cache").fetchone()[0]
+        if count > self.max_entries:
+            evicted += self.conn.execute(
+                "DELETE FROM gemini_cache WHERE key IN (SELECT key FROM gemini_cache ORDER BY last_access ASC LIMIT ?)",
+                (count - self.max_entries,),
+            ).rowcount
+        self.stats["evictions"] += evicted
+
+    def info(self):
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM gemini_cache").fetchone()[0]
+            stats = dict(self.stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats.update(entries=entries, max_entries=self.max_entries, ttl_days=self.ttl / 86400,
+                     hit_ratio=round(stats["hits"] / lookups, 3) if lookups else None, path=self.path)
+        return stats
+
+# Rendering delle pagine PDF (in memoria, file di debug solo con KEEP_PAGE_IMAGES=1)
+PAGE_MAX_SIDE = int(os.getenv("PAGE_MAX_SIDE", "1024"))
+PAGE_JPEG_QUALITY = int(os.getenv("PAGE_JPEG_QUALITY", "85"))
+KEEP_PAGE_IMAGES = os.getenv("KEEP_PAGE_IMAGES", "0") == "1"
+# Rasterizzazione multi-core opzionale: pool di processi condiviso tra i job (0 = disabilitato)
+RASTER_PROCESSES = int(os.getenv("RASTER_PROCESSES", "0"))
+RASTER_POOL_MIN_PAGES = int(os.getenv("RASTER_POOL_MIN_PAGES", "8"))
+
+_raster_pool = None
+_raster_pool_lock = threading.Lock()
+
+def get_raster_pool():
+    """Restituisce il pool di processi per il rendering (creato alla prima richiesta), o None se disabilitato."""
+    global _raster_pool
+    if RASTER_PROCESSES <= 0:
+        return None
+    with _raster_pool_lock:
+        if _raster_pool is None:
+            # "spawn": i worker importano solo raster_worker ed evitano fork di un processo multi-thread
+            _raster_pool = ProcessPoolExecutor(max_workers=RASTER_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+            logger.info(f"🧩 Pool di rasterizzazione avviato con {RASTER_PROCESSES} processi.")
+        return _raster_pool
+
+gemini_cache = None
+if GEMINI_CACHE_ENABLED:
+    try:
+        gemini_cache = GeminiResultCache()
+    except Exception as e:
+        logger.error(f"❌ Errore inizializzazione cache Gemini: {e}")
+
+# Stato dei crawl per URL: evita di riscaricare ed estrarre volantini non cambiati
+FLYER_STATE_ENABLED = os.getenv("FLYER_STATE_ENABLED", "1") == "1"
+
+class FlyerStateStore:
+    """Stato SQLite dell'ultimo crawl di ogni URL: ETag, Last-Modified, SHA-256 del contenuto e risultato associato
+    (elenco volantini per la pagina indice, prodotti estratti per i PDF)."""
+    def __init__(self, path=None):
+        self.path = path or os.getenv("FLYER_STATE_PATH") or _default_state_path("flyer_state.sqlite3")
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS flyer_state ("
+            "url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, sha256 TEXT, job_id TEXT, payload TEXT, updated REAL NOT NULL)"
+        )
+        self.conn.commit()
+
+    def get(self, url):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT etag, last_modified, sha256, job_id, payload, updated FROM flyer_state WHERE url = ?", (url,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"url": url, "etag": row[0], "last_modified": row[1], "sha256": row[2], "job_id": row[3],
+                "payload": json.loads(row[4]) if row[4] is not None else None, "updated": row[5]}
+
+    def put(self, url, etag=None, last_modified=None, sha256=None, job_id=None, payload=None):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO flyer_state (url, etag, last_modified, sha256, job_id, payload, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, etag, last_modified, sha256, job_id,
+                 json.dumps(payload, ensure_ascii=False) if payload is not None else None, time.time()),
+            )
+            self.conn.commit()
+
+    @staticmethod
+    def conditional_headers(state):
+        headers = {}
+        if state.get("etag"):
+            headers["If-None-Match"] = state["etag"]
+        if state.get("last_modified"):
+            headers["If-Modified-Since"] = state["last_modified"]
+        return headers
+
+flyer_state = None
+if FLYER_STATE_ENABLED:
+    try:
+        flyer_state = FlyerStateStore()
+    except Exception as e:
+        logger.error(f"❌ Errore inizializzazione stato dei crawl: {e}")
+
+# Catalogo dei file di risultati: evita glob e stat di tutti i file a ogni richiesta
+RESULTS_PATTERN = "gemini_results_*.json"
+
+def results_file_path(job_id):
+    return f"gemini_results_{job_id}.json"
+
+class ResultsCatalog:
+    """Catalogo SQLite dei file gemini_results_*.json (job, volantino, conteggi, dimensione, date).
+
+    Ogni run registra il proprio file; all'avvio il catalogo si riallinea una sola volta con i file
+    presenti su disco (aggiunge quelli mancanti, rimuove quelli cancellati).
+    """
+    COLUMNS = ("job_id", "file", "volantino_name", "volantino_url", "supermercato", "total_products", "size", "created", "modified")
+
+    def __init__(self, path=None, pattern=RESULTS_PATTERN):
+        self.path = path or os.getenv("RESULTS_CATALOG_PATH") or _default_state_path("results_catalog.sqlite3")
+        self.pattern = pattern
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "job_id TEXT PRIMARY KEY, file TEXT NOT NULL, volantino_name TEXT, volantino_url TEXT, supermercato TEXT, "
+            "total_products INTEGER NOT NULL, size INTEGER NOT NULL, created REAL NOT NULL, modified REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ix_results_modified ON results(modified)")
+        self.conn.commit()
+        self.bootstrap()
+
+    def record(self, job_id, file_path, products, volantino=None, supermercato=None, created=None):
+        volantino = volantino or {}
+        st = os.stat(file_path)
+        with self.lock:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO results ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})",
+                (job_id, file_path, volantino.get("name"), volantino.get("url"), supermercato,
+                 len(products), st.st_size, created or time.time(), st.st_mtime),
+            )
+            self.conn.commit()
+
+    def bootstrap(self):
+        with self.lock:
+            known = {row[0] for row in self.conn.execute("SELECT file FROM results")}
+        on_disk = set(glob.glob(self.pattern))
+        for fp in sorted(on_disk - known):
+            try:
+                with open(fp, "r", encoding="utf-8") as f:
+                    products = json.load(f).get("products", [])
+            except Exception as e:
+                logger.warning(f"⚠️ File risultati non leggibile {fp}: {e}")
+                continue
+            first = products[0] if products else {}
+            job_id = os.path.basename(fp)[len("gemini_results_"):-len(".json")]
+            self.record(job_id, fp, products, {"name": first.get("volantino_name"), "url": first.get("volantino_url")},
+                        first.get("supermercato"), created=os.path.getmtime(fp))
+        missing = known - on_disk
+        if missing:
+            with self.lock:
+                self.conn.executemany("DELETE FROM results WHERE file = ?", [(fp,) for fp in missing])
+                self.conn.commit()
+        if on_disk - known or missing:
+            logger.info(f"🗂️ Catalogo risultati allineato: +{len(on_disk - known)} / -{len(missing)} file")
+
+    def _rows(self, sql, params=()):
+        with self.lock:
+            return [dict(zip(self.COLUMNS, row)) for row in self.conn.execute(sql, params)]
+
+    def list(self):
+        return self._rows(f"SELECT {', '.join(self.COLUMNS)} FROM results ORDER BY file")
+
+    def latest(self):
+        rows = self._rows(f"SELECT {', '.join(self.COLUMNS)} FROM results ORDER BY modified DESC LIMIT 1")
+        return rows[0] if rows else None
+
+    def get(self, job_id):
+        rows = self._rows(f"SELECT {', '.join(self.COLUMNS)} FROM results WHERE job_id = ?", (job_id,))
+        return rows[0] if rows else None
+
+    def remove(self, job_id):
+        with self.lock:
+            self.conn.execute("DELETE FROM results WHERE job_id = ?", (job_id,))
+            self.conn.commit()
+
+results_catalog = ResultsCatalog()
+
+# Risultati incrementali: NDJSON append-only (un prodotto per riga), opzionalmente gzip per pagina
+RESULTS_COMPRESS = os.getenv("RESULTS_COMPRESS", "0") == "1"
+
+class ResultsLog:
+    """Log append-only dei prodotti di un job, scritto pagina per pagina.
+
+    I prodotti di ogni pagina formano un blocco di righe NDJSON (con RESULTS_COMPRESS=1 un membro gzip
+    a sé, così il file resta un gzip valido). Il file indice `.idx` registra per ogni blocco pagina,
+    offset, lunghezza, numero di prodotti e stato: i lettori saltano direttamente alla pagina voluta o
+    scorrono i prodotti senza caricare il file. Se una pagina viene riscritta vale l'ultimo blocco.
+    """
+    def __init__(self, job_id, compress=None):
+        self.job_id = job_id
+        base = f"gemini_results_{job_id}.ndjson"
+        gz_path = base + ".gz"
+        if compress is None:
+            # Un log esistente mantiene il proprio formato
+            compress = os.path.exists(gz_path) or (not os.path.exists(base) and RESULTS_COMPRESS)
+        self.compress = compress
+        self.path = gz_path if compress else base
+        self.index_path = self.path + ".idx"
+        # Manifest del checkpoint (sorgente, pagine totali, dati del volantino) per il resume
+        self.checkpoint_path = base + ".ckpt"
+        self.lock = threading.Lock()
+        self._data = None
+        self._index = None
+
+    def exists(self):
+        return os.path.exists(self.index_path)
+
+    def append_page(self, page_number, products, status="ok"):
+        """Aggiunge il blocco di una pagina e lo rende persistente prima di restituire."""
+        block = "".join(json.dumps(p, ensure_ascii=False) + "\n" for p in products).encode("utf-8")
+        if self.compress and block:
+            block = gzip.compress(block)
+        with self.lock:
+            if self._data is None:
+                self._data = open(self.path, "ab")
+                self._index = open(self.index_path, "a", encoding="utf-8")
+            offset = self._data.seek(0, os.SEEK_END)
+            self._data.write(block)
+            self._data.flush()
+            os.fsync(self._data.fileno())
+            entry = {"page": page_number, "offset": offset, "length": len(block), "products": len(products), "status": status}
+            self._index.write(json.dumps(entry) + "\n")
+            self._index.flush()
+            os.fsync(self._index.fileno())
+
+    def close(self):
+        with self.lock:
+            for f in (self._data, self._index):
+                if f is not None:
+                    f.close()
+            self._data = self._index = None
+
+    def pages(self):
+        """Ultimo blocco registrato per ogni pagina, in ordine di pagina."""
+        latest = {}
+        if self.exists():
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # riga troncata da un'interruzione durante la scrittura
+                    latest[entry["page"]] = entry
+        return [latest[page] for page in sorted(latest)]
+
+    def iter_products(self, page=None):
+        """Prodotti del job (o della sola pagina `page`) letti blocco per blocco dal disco."""
+        entries = [e for e in self.pages() if page is None or e["page"] == page]
+        if not entries:
+            return
+        with open(self.path, "rb") as f:
+            for entry in entries:
+                if not entry["length"]:
+                    continue
+                f.seek(entry["offset"])
+                block = f.read(entry["length"])
+                if self.compress:
+                    block = gzip.decompress(block)
+                for line in block.decode("utf-8").splitlines():
+                    yield json.loads(line)
+
+    def write_checkpoint(self, manifest):
+        tmp = self.checkpoint_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(tmp, self.checkpoint_path)
+
+    def read_checkpoint(self):
+        try:
+            with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def remove_checkpoint(self):
+        with suppress(FileNotFoundError):
+            os.remove(self.checkpoint_path)
+
+    def remove(self):
+        """Cancella log e indice (il JSON esportato resta)."""
+        self.close()
+        for path in (self.path, self.index_path):
+            with suppress(FileNotFoundError):
+                os.remove(path)
+
+    def export_json(self, output_file, method="Gemini AI Extractor (Colab)"):
+        """Vista derivata nel formato JSON storico (gemini_results_<job>.json)."""
+        products = list(self.iter_products())
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump({'timestamp': datetime.now().isoformat(), 'method': method,
+                       'total_products': len(products), 'products': products}, f, indent=2, ensure_ascii=False)
+        return products
+
+# Retention dei file di lavoro dei job (0 = nessuna rimozione): checkpoint non ripresi (manifest .ckpt e
+# cartella temp_processing_<job>) e log NDJSON dei job già esportati in gemini_results_<job>.json
+CHECKPOINT_RETENTION_HOURS = float(os.getenv("CHECKPOINT_RETENTION_HOURS", "72"))
+RESULTS_LOG_RETENTION_DAYS = float(os.getenv("RESULTS_LOG_RETENTION_DAYS", "7"))
+
+def _older_than(path, limit):
+    try:
+        return os.path.getmtime(path) < limit
+    except OSError:
+        return False
+
+def prune_job_files(now=None):
+    """Applica la retention ai file di lavoro dei job e restituisce quanti ne sono stati rimossi.
+
+    Un checkpoint scaduto non è più riprendibile. Il log NDJSON viene rimosso solo se il job non ha
+    un checkpoint e il JSON esportato esiste: /results/{job_id}/products ripiega su quel file.
+    """
+    now = now or time.time()
+    removed = 0
+    if CHECKPOINT_RETENTION_HOURS > 0:
+        limit = now - CHECKPOINT_RETENTION_HOURS * 3600
+        for ckpt in glob.glob("gemini_results_*.ndjson.ckpt"):
+            job_id = ckpt[len("gemini_results_"):-len(".ndjson.ckpt")]
+            # Il manifest viene riscritto a ogni avvio o resume: la sua data è l'ultima attività del job
+            if _older_than(ckpt, limit):
+                shutil.rmtree(f"temp_processing_{job_id}", ignore_errors=True)
+                ResultsLog(job_id).remove_checkpoint()
+                removed += 1
+        for temp_dir in glob.glob("temp_processing_*"):
+            job_id = temp_dir[len("temp_processing_"):]
+            if not os.path.exists(ResultsLog(job_id).checkpoint_path) and _older_than(temp_dir, limit):
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                removed += 1
+    if RESULTS_LOG_RETENTION_DAYS > 0:
+        limit = now - RESULTS_LOG_RETENTION_DAYS * 86400
+        for index_path in glob.glob("gemini_results_*.ndjson*.idx"):
+            job_id = index_path[len("gemini_results_"):].split(".ndjson")[0]
+            log = ResultsLog(job_id)
+            if os.path.exists(log.checkpoint_path) or not os.path.exists(results_file_path(job_id)):
+                continue
+            if _older_than(index_path, limit):
+                log.remove()
+                removed += 1
+    if removed:
+        logger.info(f"🧹 Retention: rimossi {removed} checkpoint/log di job scaduti.")
+    return removed
+
+prune_job_files()
+
 class MultiAIExtractor:
-    def __init__(self, gemini_api_key="", gemini_api_key_2=None, job_id=None, db_manager=None, enable_fallback=False, supermercato_nome="SUPERMERCATO"):
+    def __init__(self, gemini_api_key="", gemini_api_key_2=None, job_id=None, db_manager=None, enable_fallback=False, supermercato_nome="SUPERMERCATO", page_concurrency=None, volantino=None, on_page=None, force_refresh=False, batch_pages=None):
         logger.info("🤖 Inizializzando estrattore Multi-AI con Gemini...")
 
         self.gemini_api_key = gemini_api_key or os.getenv('GEMINI_API_KEY')
@@ -367,13 +1645,12 @@ class MultiAIExtractor:
 
         # Ultimo modello stabile
         self.MODEL_NAME = "gemini-2.5-flash"
-        self.gemini_url = f"https://generativelanguage.googleapis.com/v1beta/models/{self.MODEL_NAME}:generateContent?key={self.gemini_api_key}"
-        self.gemini_url_2 = f"https://generativelanguage.googleapis.com/v1beta/models/{self.MODEL_NAME}:generateContent?key={self.gemini_api_key_2}" if self.gemini_api_key_2 else None
+        self.gemini_url = f"{GEMINI_API_BASE}/v1beta/models/{self.MODEL_NAME}:generateContent?key={self.gemini_api_key}"
+        self.gemini_url_2 = f"{GEMINI_API_BASE}/v1beta/models/{self.MODEL_NAME}:generateContent?key={self.gemini_api_key_2}" if self.gemini_api_key_2 else None
 
-        self.job_id = job_id or str(int(time.time()))
+        self.job_id = job_id or new_job_id()
         self.db_manager = db_manager
         self.enable_fallback = enable_fallback and (MOONDREAM_AVAILABLE or QWEN_AVAILABLE)
-        self.current_key_index = 0
         self.api_keys = [self.gemini_api_key]
         self.api_urls = [self.gemini_url]
 
@@ -394,75 +1671,130 @@ class MultiAIExtractor:
         else:
             self.product_images_dir = Path("multi_ai_product_images")
         self.product_images_dir.mkdir(parents=True, exist_ok=True)
+        self.image_store = ImageStore(self.product_images_dir)
 
         self.card_generator = ProductCardGenerator()
         self.supermercato_nome = supermercato_nome
+        # Numero di pagine analizzate in parallelo
+        self.page_concurrency = max(1, page_concurrency or GEMINI_PAGE_CONCURRENCY or 4 * len(self.api_keys))
+        self.batch_pages = max(1, batch_pages or GEMINI_BATCH_PAGES)
+        # Dati del volantino (url/name/validity) applicati a ogni prodotto prima del salvataggio
+        self.volantino = volantino or {}
+        # Callback opzionale on_page(numero_pagina, totale_pagine, prodotti) chiamata a fine pagina, in ordine
+        self.on_page = on_page
+        # Con force_refresh il PDF viene sempre scaricato ed estratto, ignorando lo stato dei crawl
+        self.force_refresh = force_refresh
+        self.download_state = None   # ETag/Last-Modified/SHA-256 dell'ultimo download, salvati a fine run
+        self.unchanged_state = None  # stato precedente quando il PDF risulta invariato
+        self.results_log = ResultsLog(self.job_id)
+        self.total_pages = None  # noto dopo l'apertura del PDF; serve a decidere se conservare il checkpoint
 
     def download_pdf_from_url(self, url):
-        """Scarica PDF da URL"""
+        """Scarica PDF da URL (richiesta condizionale se l'URL è già stato estratto in passato)"""
         try:
             logger.info(f"📥 Scaricando PDF da URL: {url}")
             headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)'}
-            response = requests.get(url, stream=True, timeout=30, headers=headers)
-            if response.status_code == 200:
+            state = flyer_state.get(url) if flyer_state is not None and not self.force_refresh else None
+            if state and state['payload'] is None:
+                state = None
+            if state:
+                headers.update(FlyerStateStore.conditional_headers(state))
+            # Il blocco with rilascia la connessione al pool anche quando il corpo non viene letto (304, errori)
+            download_start = time.perf_counter()
+            with http_session.get(url, stream=True, timeout=(HTTP_CONNECT_TIMEOUT, 30), headers=headers) as response:
+                if response.status_code == 304 and state:
+                    logger.info(f"♻️ PDF invariato (304) dal job {state['job_id']}.")
+                    metrics.inc("deco_pdf_download_total", result="not_modified")
+                    self.unchanged_state = state
+                    return None
+                if response.status_code != 200:
+                    logger.error(f"❌ Errore HTTP download PDF: {response.status_code}")
+                    metrics.inc("deco_pdf_download_total", result="error")
+                    return None
                 filename = f"downloaded_pdf_{self.job_id}.pdf"
                 pdf_path = self.temp_dir / filename
+                digest = hashlib.sha256()
+                size = 0
                 with open(pdf_path, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
+                    for chunk in response.iter_content(chunk_size=65536):
                         f.write(chunk)
-                logger.info(f"✅ PDF scaricato: {pdf_path}")
-                return str(pdf_path)
-            else:
-                logger.error(f"❌ Errore HTTP download PDF: {response.status_code}")
-                return None
+                        digest.update(chunk)
+                        size += len(chunk)
+                self.download_state = {"url": url, "etag": response.headers.get('ETag'),
+                                       "last_modified": response.headers.get('Last-Modified'), "sha256": digest.hexdigest()}
+            metrics.observe("deco_pdf_download_seconds", time.perf_counter() - download_start)
+            metrics.inc("deco_pdf_download_bytes_total", size)
+            metrics.inc("deco_pdf_download_total", result="ok")
+            if state and state['sha256'] == self.download_state['sha256']:
+                logger.info(f"♻️ PDF invariato (stesso SHA-256) dal job {state['job_id']}.")
+                self.unchanged_state = state
+            logger.info(f"✅ PDF scaricato: {pdf_path}")
+            return str(pdf_path)
         except Exception as e:
             logger.error(f"❌ Errore download PDF: {e}")
+            metrics.inc("deco_pdf_download_total", result="error")
             return None
 
-    def convert_pdf_to_images(self, pdf_path):
-        """Converte PDF in immagini PNG"""
-        try:
-            logger.info(f"📄 Convertendo PDF in immagini: {pdf_path}")
-            doc = fitz.open(pdf_path)
-            image_paths = []
-            for page_num in range(len(doc)):
-                page = doc.load_page(page_num)
-                mat = fitz.Matrix(2.0, 2.0)
-                pix = page.get_pixmap(matrix=mat)
-                image_filename = f"page_{page_num + 1}.png"
-                image_path = self.temp_dir / image_filename
-                pix.save(str(image_path))
-                image_paths.append(str(image_path))
-            doc.close()
-            logger.info(f"✅ PDF convertito in {len(image_paths)} immagini")
-            return image_paths
-        except Exception as e:
-            logger.error(f"❌ Errore conversione PDF: {e}")
-            return []
+    def iter_pdf_pages(self, pdf_path, pages=None):
+        """Renderizza le pagine direttamente alla risoluzione di analisi e restituisce (numero_pagina, JPEG in memoria) in ordine.
 
-    def image_to_base64(self, image_path):
-        """Converte immagine in base64 per Gemini"""
+        `pages` (numeri da 1) limita il rendering a un sottoinsieme, usato dal resume.
+        """
+        with fitz.open(pdf_path) as doc:
+            page_count = doc.page_count
+            page_numbers = [p for p in pages if 1 <= p <= page_count] if pages is not None else list(range(1, page_count + 1))
+            pool = get_raster_pool() if len(page_numbers) >= RASTER_POOL_MIN_PAGES else None
+            if pool is None:
+                for page_number in page_numbers:
+                    with metrics.time("deco_raster_page_seconds", mode="inline"):
+                        jpeg_bytes = render_page_jpeg(doc.load_page(page_number - 1), PAGE_MAX_SIDE, PAGE_JPEG_QUALITY)
+                    yield self._keep_page_image(page_number, jpeg_bytes)
+                return
+
+        # Ogni worker apre il documento e renderizza una porzione contigua di pagine;
+        # al massimo due porzioni per processo sono in volo, così la memoria resta limitata
+        chunk_size = max(1, -(-len(page_numbers) // (RASTER_PROCESSES * 4)))
+        chunks = [page_numbers[i:i + chunk_size] for i in range(0, len(page_numbers), chunk_size)]
+        pending = deque()
+        next_chunk = 0
+        while next_chunk < len(chunks) or pending:
+            while next_chunk < len(chunks) and len(pending) < RASTER_PROCESSES * 2:
+                pending.append((time.perf_counter(), pool.submit(render_pages, str(pdf_path), chunks[next_chunk], PAGE_MAX_SIDE, PAGE_JPEG_QUALITY)))
+                next_chunk += 1
+            submitted, future = pending.popleft()
+            rendered = future.result()
+            for _ in rendered:
+                metrics.observe("deco_raster_page_seconds", (time.perf_counter() - submitted) / len(rendered), mode="pool")
+            for page_number, jpeg_bytes in rendered:
+                yield self._keep_page_image(page_number, jpeg_bytes)
+
+    def _keep_page_image(self, page_number, jpeg_bytes):
+        if KEEP_PAGE_IMAGES:
+            (self.temp_dir / f"page_{page_number}.jpg").write_bytes(jpeg_bytes)
+        return page_number, jpeg_bytes
+
+    def image_to_base64(self, image_data):
+        """Converte immagine (byte JPEG o percorso file) in base64 per Gemini"""
         try:
-            with Image.open(image_path) as img:
-                if img.width > 1024 or img.height > 1024:
-                    img.thumbnail((1024, 1024), Image.Resampling.LANCZOS)
+            if isinstance(image_data, bytes):
+                return base64.b64encode(image_data).decode('utf-8')
+            with Image.open(image_data) as img:
+                if img.width > PAGE_MAX_SIDE or img.height > PAGE_MAX_SIDE:
+                    img.thumbnail((PAGE_MAX_SIDE, PAGE_MAX_SIDE), Image.Resampling.LANCZOS)
                 if img.mode != 'RGB':
                     img = img.convert('RGB')
                 buffer = BytesIO()
-                img.save(buffer, format='JPEG', quality=85)
+                img.save(buffer, format='JPEG', quality=PAGE_JPEG_QUALITY)
                 buffer.seek(0)
                 return base64.b64encode(buffer.getvalue()).decode('utf-8')
         except Exception as e:
             logger.error(f"❌ Errore conversione base64: {e}")
             return None
 
-    def get_next_api_config(self):
-        """Ottiene la prossima configurazione API per bilanciare il carico"""
-        if len(self.api_keys) > 1:
-            self.current_key_index = (self.current_key_index + 1) % len(self.api_keys)
-
-        current_key = self.api_keys[self.current_key_index]
-        current_url = self.api_urls[self.current_key_index]
+    def get_next_api_config(self, estimated_tokens=GEMINI_ESTIMATED_TOKENS):
+        """Ottiene dallo scheduler condiviso la chiave con più margine (attende se tutte sono sature)"""
+        current_key = gemini_scheduler.acquire(self.api_keys, estimated_tokens)
+        current_url = self.api_urls[self.api_keys.index(current_key)]
 
         return current_key, current_url
 
@@ -491,167 +1823,304 @@ class MultiAIExtractor:
         except ValueError:
             return 0.0
 
-    def save_product_to_db(self, product_info):
-        """Salva le informazioni del prodotto nel DB (simulato)"""
-        if self.db_manager:
+    def save_products_to_db(self, products):
+        """Salva in blocco i prodotti di una pagina nel DB (reale o simulato); imposta `db_id` sui prodotti salvati"""
+        if self.db_manager and products:
             try:
                 # La funzione convert_price_to_float è ora robusta
-                product_info['prezzo_float'] = self.convert_price_to_float(product_info.get('prezzo'))
-
-                saved_products = self.db_manager.save_products(self.job_id, [product_info])
-                if saved_products:
-                    return saved_products[0].get('db_id')
-                return None
+                for product_info in products:
+                    product_info['prezzo_float'] = self.convert_price_to_float(product_info.get('prezzo'))
+                with metrics.time("deco_db_ingest_seconds"):
+                    saved = self.db_manager.save_products(self.job_id, products)
+                metrics.inc("deco_db_products_total", len(products))
+                return saved
             except Exception as e:
-                logger.error(f"❌ Errore salvataggio prodotto nel DB simulato: {e}")
-                return None
-        return None
+                logger.error(f"❌ Errore salvataggio prodotti nel DB: {e}")
+        return []
 
-    def _save_original_image_fallback(self, original_image_path, page_number):
+    def _save_original_image_fallback(self, page_jpeg, page_number):
         """Salva l'immagine originale come fallback se non si riescono a ritagliare i prodotti"""
         try:
-            filename = f"job{self.job_id}_page{page_number}_original.jpg"
-            filepath = self.product_images_dir / filename
-            shutil.copy(original_image_path, filepath)
-            return str(filepath)
+            return self.image_store.put(page_jpeg)
         except Exception as e:
             logger.error(f"❌ Errore salvataggio immagine originale fallback: {e}")
             return None
 
-    def save_product_image(self, original_image_path, bbox, product_info, page_number, product_index):
-        """Salva l'immagine ridimensionata come card (simulata)"""
+    def save_product_images(self, page_jpeg, products, page_number):
+        """Genera in blocco le card di tutti i prodotti di una pagina a partire dai riquadri restituiti da Gemini"""
         try:
-            card_filepath = self.card_generator.save_product_card(
-                product_info,
-                original_image_path,
-                self.product_images_dir,
-                f"job{self.job_id}_page{page_number}_prod{product_index}",
-                self.job_id,
-                self.supermercato_nome
-            )
-            return card_filepath
+            with metrics.time("deco_card_write_seconds"):
+                paths = self.card_generator.save_product_cards(products, page_jpeg, self.image_store)
+            metrics.inc("deco_cards_written_total", sum(1 for path in paths if path))
+            return paths
         except Exception as e:
-            logger.error(f"❌ Errore salvataggio immagine prodotto/card: {e}")
-            return None
+            logger.error(f"❌ Errore salvataggio immagini prodotto/card: {e}")
+            return [None] * len(products)
 
-    def analyze_with_gemini(self, image_path, retry_count=3):
-        """Analizza immagine con Gemini AI con retry e restituisce la LISTA di prodotti"""
+    def analyze_with_gemini(self, image_data, retry_count=3, use_cache=True):
+        """Analizza immagine (byte JPEG o percorso) con Gemini AI con retry e restituisce la LISTA di prodotti.
+
+        Solleva GeminiAnalysisError se la pagina non può essere analizzata, così da distinguerla da una pagina senza prodotti.
+        Con `use_cache=False` (resume) la cache non viene letta, ma il nuovo risultato la aggiorna.
+        """
+        with metrics.time("deco_encode_seconds"):
+            image_base64 = self.image_to_base64(image_data)
+        if not image_base64: return []
+
+        cache_key, cached = self._cache_lookup(image_base64, use_cache)
+        if cached is not None:
+            logger.info(f"💾 Cache hit: {len(cached)} prodotti senza chiamare Gemini.")
+            return cached
+        return self._analyze_single(image_base64, cache_key, retry_count)
+
+    def _cache_lookup(self, image_base64, use_cache=True):
+        """Restituisce (chiave, prodotti in cache o None); la chiave è None se la cache è disabilitata."""
+        if gemini_cache is None:
+            return None, None
+        cache_key = GeminiResultCache.make_key(image_base64, GEMINI_PROMPT, self.MODEL_NAME)
+        if not use_cache:
+            return cache_key, None
+        cached = gemini_cache.get(cache_key)
+        metrics.inc("deco_gemini_cache_total", result="hit" if cached is not None else "miss")
+        return cache_key, cached
+
+    def _analyze_single(self, image_base64, cache_key, retry_count=3):
+        """Una pagina per chiamata. Errori temporanei e JSON non valido condividono gli stessi `retry_count` tentativi."""
+        parts = [{"text": GEMINI_PROMPT}, {"inline_data": {"mime_type": "image/jpeg", "data": image_base64}}]
         for attempt in range(retry_count):
             try:
-                current_key, current_url = self.get_next_api_config()
-
-                image_base64 = self.image_to_base64(image_path)
-                if not image_base64: return []
+                result = self._generate_content(parts, GEMINI_MAX_OUTPUT_TOKENS)
+            except GeminiRetryableError as e:
+                if attempt == retry_count - 1:
+                    logger.error(f"❌ Fallimento dopo {retry_count} tentativi.")
+                    raise GeminiAnalysisError(f"{e} dopo {retry_count} tentativi")
+                metrics.inc("deco_gemini_retries_total", reason=e.reason)
+                continue
+            if result is None:
+                return []
+            gemini_batch_sizer.observe(result[2], 1)
+            try:
+                product_data = self._parse_response_text(result[0])
+            except json.JSONDecodeError as json_e:
+                logger.error(f"❌ Errore JSON parse (probabilmente troncato): {json_e}")
+                metrics.inc("deco_gemini_json_errors_total")
+                if attempt == retry_count - 1:
+                    raise GeminiAnalysisError(f"Risposta JSON non valida: {json_e}")
+                metrics.inc("deco_gemini_retries_total", reason="json_error")
+                continue
+            if 'prodotti' in product_data and isinstance(product_data['prodotti'], list):
+                logger.info(f"✅ Gemini ha estratto {len(product_data['prodotti'])} prodotti.")
+                if cache_key is not None:
+                    gemini_cache.put(cache_key, product_data['prodotti'])
+                return product_data['prodotti']
+            logger.warning(f"⚠️ Risposta Gemini non contiene lista 'prodotti' valida.")
+            return []
+        return []
 
-                prompt = """
-Analizza questa immagine di un volantino di supermercato italiano e estrai SOLO le informazioni sui prodotti alimentari visibili.
+    def analyze_pages_with_gemini(self, images, retry_count=3, use_cache=True):
+        """Analizza più pagine con chiamate batch e restituisce, per ogni immagine, la lista di prodotti o l'eccezione.
 
-Rispondi ESCLUSIVAMENTE con un JSON valido. Lo schema JSON richiesto è:
-{
-  "prodotti": [
-    {
-      "nome": "nome completo del prodotto",
-      "marca": "marca del prodotto (es: Barilla, Mulino Bianco, Granarolo)",
-      "categoria": "categoria (latticini, pasta, bevande, dolci, etc.)",
-      "prezzo": "prezzo in euro se visibile (es: 2.49)",
-      "descrizione": "breve descrizione del prodotto"
-    }
-  ]
-}
+        Le pagine in cache non vengono inviate (salvo `use_cache=False`). Un batch troncato (MAX_TOKENS o
+        JSON non valido), con prodotti non attribuibili a un'immagine o respinto con un errore non
+        temporaneo viene diviso a metà e le due metà ritentate, fino alla chiamata a pagina singola;
+        gli errori temporanei (429, 5xx, rete) ripetono il batch intero. La cache viene scritta solo
+        per le pagine di un batch interamente attribuito.
+        """
+        results = [None] * len(images)
+        pending = []
+        for index, image_data in enumerate(images):
+            with metrics.time("deco_encode_seconds"):
+                image_base64 = self.image_to_base64(image_data)
+            if not image_base64:
+                results[index] = []
+                continue
+            cache_key, cached = self._cache_lookup(image_base64, use_cache)
+            if cached is not None:
+                results[index] = cached
+            else:
+                pending.append((index, image_base64, cache_key))
+        if pending:
+            self._analyze_batch(pending, results, retry_count)
+        return results
+
+    def _analyze_batch(self, batch, results, retry_count):
+        if len(batch) == 1:
+            index, image_base64, cache_key = batch[0]
+            try:
+                results[index] = self._analyze_single(image_base64, cache_key, retry_count)
+            except Exception as e:
+                results[index] = e
+            return
+
+        n = len(batch)
+        metrics.observe("deco_gemini_batch_pages", n)
+        parts = [{"text": GEMINI_BATCH_PROMPT.replace("{n}", str(n))}]
+        for k, (_, image_base64, _) in enumerate(batch, start=1):
+            parts.append({"text": f"Immagine {k}"})
+            parts.append({"inline_data": {"mime_type": "image/jpeg", "data": image_base64}})
+        result = None
+        for attempt in range(retry_count):
+            try:
+                result = self._generate_content(parts, GEMINI_BATCH_OUTPUT_TOKENS, estimated_tokens=GEMINI_ESTIMATED_TOKENS * n)
+                break
+            except GeminiRetryableError as e:
+                if attempt == retry_count - 1:
+                    # Quota o servizio non disponibili: dividere il batch moltiplicherebbe solo le chiamate
+                    logger.error(f"❌ Fallimento del batch di {n} pagine dopo {retry_count} tentativi.")
+                    error = GeminiAnalysisError(f"{e} dopo {retry_count} tentativi")
+                    for index, _, _ in batch:
+                        results[index] = error
+                    return
+                metrics.inc("deco_gemini_retries_total", reason=e.reason)
+            except GeminiAnalysisError as e:
+                # Errore non temporaneo (4xx, risposta inattesa): probabilmente dovuto a una pagina, il batch viene diviso
+                logger.warning(f"✂️ Batch di {n} pagine respinto ({e}): divido in {n // 2} + {n - n // 2}.")
+                metrics.inc("deco_gemini_batch_splits_total", reason="error")
+                self._analyze_batch(batch[:n // 2], results, retry_count)
+                self._analyze_batch(batch[n // 2:], results, retry_count)
+                return
+        if result is None:
+            for index, _, _ in batch:
+                results[index] = []
+            return
+
+        text, finish_reason, output_tokens = result
+        product_data = None
+        if finish_reason != "MAX_TOKENS":
+            try:
+                product_data = self._parse_response_text(text)
+            except json.JSONDecodeError as json_e:
+                logger.error(f"❌ Errore JSON parse nel batch di {n} pagine: {json_e}")
+                metrics.inc("deco_gemini_json_errors_total")
+        if product_data is None:
+            reason = "max_tokens" if finish_reason == "MAX_TOKENS" else "json_error"
+            logger.warning(f"✂️ Risposta batch troncata ({reason}): divido {n} pagine in {n // 2} + {n - n // 2}.")
+            metrics.inc("deco_gemini_batch_splits_total", reason=reason)
+            gemini_batch_sizer.truncated(n)
+            self._analyze_batch(batch[:n // 2], results, retry_count)
+            self._analyze_batch(batch[n // 2:], results, retry_count)
+            return
+
+        gemini_batch_sizer.observe(output_tokens, n)
+        pages = [[] for _ in batch]
+        prodotti = product_data.get('prodotti') if isinstance(product_data, dict) else None
+        unattributed = 0 if isinstance(prodotti, list) else 1
+        for product in prodotti if isinstance(prodotti, list) else []:
+            try:
+                k = int(product.pop('immagine', None))
+            except (AttributeError, TypeError, ValueError):
+                k = 0
+            if 1 <= k <= n:
+                pages[k - 1].append(product)
+            else:
+                unattributed += 1
+        if unattributed:
+            # Senza attribuzione affidabile nessuna pagina del batch è attendibile (nemmeno le vuote):
+            # come per una risposta troncata il batch viene diviso, fino alla chiamata a pagina singola
+            logger.warning(f"✂️ Risposta batch senza lista 'prodotti' o con {unattributed} prodotti senza immagine valida: "
+                           f"divido {n} pagine in {n // 2} + {n - n // 2}.")
+            metrics.inc("deco_gemini_batch_splits_total", reason="unattributed")
+            self._analyze_batch(batch[:n // 2], results, retry_count)
+            self._analyze_batch(batch[n // 2:], results, retry_count)
+            return
+        logger.info(f"✅ Gemini ha estratto {sum(map(len, pages))} prodotti da {n} pagine in una chiamata.")
+        for (index, _, cache_key), products in zip(batch, pages):
+            if cache_key is not None:
+                gemini_cache.put(cache_key, products)
+            results[index] = products
 
-Regole importanti:
-- Il valore del campo "prezzo" DEVE essere una stringa (es: "2.49", "Non visibile").
-- Estrai SOLO prodotti alimentari chiaramente visibili
-- Se non vedi un prezzo, scrivi "Non visibile"
-- Se non riconosci una marca, scrivi "Non identificata"
-- Concentrati sui prodotti più evidenti e leggibili
-- Massimo 10 prodotti per immagine
-"""
-                payload = {
-                    "contents": [{
-                        "parts": [
-                            {"text": prompt},
-                            {
-                                "inline_data": {
-                                    "mime_type": "image/jpeg",
-                                    "data": image_base64
-                                }
-                            }
-                        ]
-                    }],
-                    "generationConfig": {
-                        "temperature": 0.1,
-                        "topK": 1,
-                        "topP": 1,
-                        # Aumentato il limite per evitare troncamento (Correzione Errore JSON parse)
-                        "maxOutputTokens": 4096,
-                        "responseMimeType": "application/json"
-                    }
+    @staticmethod
+    def _parse_response_text(text_response):
+        """Decodifica il JSON della risposta, togliendo l'eventuale blocco markdown."""
+        cleaned_response = text_response.strip()
+        if cleaned_response.startswith("```json"):
+            cleaned_response = cleaned_response[7:]
+        if cleaned_response.endswith("```"):
+            cleaned_response = cleaned_response[:-3]
+        return json.loads(cleaned_response.strip())
+
+    def _generate_content(self, parts, max_output_tokens, estimated_tokens=GEMINI_ESTIMATED_TOKENS):
+        """Una chiamata generateContent con scheduler e metriche; i tentativi sono gestiti dal chiamante.
+
+        Restituisce (testo, finishReason, token di output) del primo candidato, None se la risposta
+        non ha candidati. Solleva GeminiRetryableError per 429/5xx/errori di rete, GeminiAnalysisError
+        per gli altri errori.
+        """
+        try:
+            current_key, current_url = self.get_next_api_config(estimated_tokens)
+
+            payload = {
+                "contents": [{"parts": parts}],
+                "generationConfig": {
+                    "temperature": 0.1,
+                    "topK": 1,
+                    "topP": 1,
+                    # Limite alto per evitare troncamento (Correzione Errore JSON parse)
+                    "maxOutputTokens": max_output_tokens,
+                    "responseMimeType": "application/json"
                 }
-                headers = {'Content-Type': 'application/json'}
-                response = requests.post(current_url, json=payload, headers=headers, timeout=45)
-
-                if response.status_code == 200:
-                    result = response.json()
-                    if 'candidates' in result and len(result['candidates']) > 0:
-                        text_response = result['candidates'][0]['content']['parts'][0]['text']
-
-                        # Pulizia del codice markdown (se presente)
-                        cleaned_response = text_response.strip()
-                        if cleaned_response.startswith("```json"):
-                            cleaned_response = cleaned_response[7:]
-                        if cleaned_response.endswith("```"):
-                            cleaned_response = cleaned_response[:-3]
-                        cleaned_response = cleaned_response.strip()
-
-                        try:
-                            product_data = json.loads(cleaned_response)
-                            if 'prodotti' in product_data and isinstance(product_data['prodotti'], list):
-                                logger.info(f"✅ Gemini ha estratto {len(product_data['prodotti'])} prodotti.")
-                                return product_data['prodotti']
-                            else:
-                                logger.warning(f"⚠️ Risposta Gemini non contiene lista 'prodotti' valida.")
-                                return []
-                        except json.JSONDecodeError as json_e:
-                            logger.error(f"❌ Errore JSON parse (probabilmente troncato): {json_e}")
-                            if attempt == retry_count - 1: return []
-                            continue
-                    else:
-                        logger.warning(f"⚠️ Risposta Gemini vuota o senza candidati.")
-                        return []
-                # Gestione errori API
-                elif response.status_code in [429, 500, 503]:
-                    wait_time = min(5 * (attempt + 1), 30)
-                    logger.warning(f"⏳ Rate limit o errore server ({response.status_code}). Attesa {wait_time}s.")
-                    if attempt < retry_count - 1:
-                        time.sleep(wait_time)
-                        continue
-                    else:
-                        logger.error(f"❌ Fallimento dopo {retry_count} tentativi.")
-                        return []
-                else:
-                    logger.error(f"❌ Errore non gestito Gemini (Status: {response.status_code}): {response.text}")
-                    return []
-            except requests.exceptions.RequestException as req_e:
-                wait_time = 5 * (attempt + 1)
-                logger.error(f"❌ Errore nella richiesta: {req_e}. Attesa {wait_time}s.")
-                if attempt < retry_count - 1:
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    logger.error(f"❌ Errore richiesta non recuperabile dopo {retry_count} tentativi.")
-                    return []
-            except Exception as e:
-                logger.error(f"❌ Errore inatteso durante l'analisi: {e}")
-                return []
+            }
+            headers = {'Content-Type': 'application/json'}
+            # Etichetta per indice: /metrics non è autenticato e non deve esporre parti della chiave
+            key_label = f"key{self.api_keys.index(current_key)}"
+            if gemini_in_flight: gemini_in_flight.acquire()
+            request_start = time.perf_counter()
+            status_label = "exception"
+            try:
+                response = http_session.post(current_url, json=payload, headers=headers, timeout=(HTTP_CONNECT_TIMEOUT, 45 if len(parts) <= 2 else 120))
+                status_label = str(response.status_code)
+            except requests.exceptions.RequestException:
+                status_label = "network_error"
+                gemini_scheduler.report(current_key, None, estimated_tokens=estimated_tokens)
+                raise
+            finally:
+                if gemini_in_flight: gemini_in_flight.release()
+                metrics.observe("deco_gemini_request_seconds", time.perf_counter() - request_start, key=key_label, status=status_label)
+                metrics.inc("deco_gemini_requests_total", key=key_label, status=status_label)
 
-        return []
+            if response.status_code == 200:
+                result = response.json()
+                usage = result.get('usageMetadata', {})
+                gemini_scheduler.report(current_key, 200, estimated_tokens=estimated_tokens, tokens_used=usage.get('totalTokenCount'))
+                if 'candidates' in result and len(result['candidates']) > 0:
+                    candidate = result['candidates'][0]
+                    parts_out = candidate.get('content', {}).get('parts') or [{}]
+                    return parts_out[0].get('text', ''), candidate.get('finishReason'), usage.get('candidatesTokenCount')
+                logger.warning(f"⚠️ Risposta Gemini vuota o senza candidati.")
+                return None
+            # Gestione errori API
+            elif response.status_code == 429 or response.status_code >= 500:
+                # Il backoff è per chiave: lo scheduler blocca la chiave e instrada il retry sulle altre
+                retry_after = parse_retry_after(response)
+                gemini_scheduler.report(current_key, response.status_code, estimated_tokens=estimated_tokens, retry_after=retry_after)
+                logger.warning(f"⏳ Rate limit o errore server ({response.status_code}) sulla chiave {key_label}" + (f", Retry-After {retry_after:.0f}s." if retry_after else "."))
+                raise GeminiRetryableError(f"HTTP {response.status_code}", reason=str(response.status_code))
+            else:
+                gemini_scheduler.report(current_key, response.status_code, estimated_tokens=estimated_tokens)
+                logger.error(f"❌ Errore non gestito Gemini (Status: {response.status_code}): {response.text}")
+                raise GeminiAnalysisError(f"HTTP {response.status_code}")
+        except requests.exceptions.RequestException as req_e:
+            logger.error(f"❌ Errore nella richiesta: {req_e}.")
+            raise GeminiRetryableError(f"Richiesta non riuscita: {req_e}", reason="network_error")
+        except GeminiAnalysisError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Errore inatteso durante l'analisi: {e}")
+            raise GeminiAnalysisError(f"Errore inatteso: {e}")
 
-    def process_pdf(self, pdf_source, source_type="url"):
-        """Processa un PDF (scaricato o locale), estraendo prodotti per pagina."""
+    def process_pdf(self, pdf_source, source_type="url", resume=False):
+        """Processa un PDF (scaricato o locale), estraendo prodotti per pagina.
 
-        if source_type == "url":
+        Con `resume` riusa il PDF del checkpoint (se ancora presente) ed elabora solo le pagine
+        non completate, vuote o in errore nel log dei risultati del job.
+        """
+        checkpoint = self.results_log.read_checkpoint() if resume else None
+        if checkpoint and checkpoint.get("pdf_path") and os.path.exists(checkpoint["pdf_path"]):
+            pdf_path = checkpoint["pdf_path"]
+        elif source_type == "url":
             pdf_path = self.download_pdf_from_url(pdf_source)
+            if self.unchanged_state:
+                return self._reuse_previous_products(self.unchanged_state)
         else:
             pdf_path = pdf_source
 
@@ -661,59 +2130,197 @@ Regole importanti:
             return []
 
         logger.info(f"🚀 Inizio elaborazione PDF: {pdf_path}")
-        image_paths = self.convert_pdf_to_images(pdf_path)
+        try:
+            with fitz.open(pdf_path) as doc:
+                total_pages = doc.page_count
+        except Exception as e:
+            logger.error(f"❌ Errore apertura PDF: {e}")
+            total_pages = 0
 
-        if not image_paths:
+        if not total_pages:
             logger.error("❌ Nessuna immagine creata dal PDF.")
             if self.db_manager: self.db_manager.update_job_status(self.job_id, "failed", 0, 0, "Nessuna immagine creata dal PDF.")
             return []
 
-        total_products_extracted = 0
         all_extracted_products = []
+        self.total_pages = total_pages
+        self.results_log.write_checkpoint({
+            "job_id": self.job_id, "pdf_source": pdf_source, "source_type": source_type, "pdf_path": str(pdf_path),
+            "total_pages": total_pages, "supermercato_nome": self.supermercato_nome, "volantino": self.volantino,
+        })
+        done_pages = {e["page"] for e in self.results_log.pages() if e["status"] == "ok"} if resume else set()
+        pages = [p for p in range(1, total_pages + 1) if p not in done_pages]
+        if resume:
+            logger.info(f"🔁 Resume job {self.job_id}: {len(done_pages)} pagine già completate, {len(pages)} da rielaborare.")
+
+        if self.db_manager: self.db_manager.update_job_status(self.job_id, "processing", 0, total_pages, "Inizio analisi immagini...")
+
+        # Pipeline: ogni pagina viene inviata all'analisi appena renderizzata; al massimo `max_in_flight`
+        # pagine restano in memoria, e i risultati vengono consumati in ordine di pagina
+        # Con il batching le pagine vengono raggruppate (dimensione scelta da gemini_batch_sizer) e ogni
+        # pagina riceve il proprio Future, risolto quando termina la chiamata del suo gruppo
+        workers = max(1, min(self.page_concurrency, len(pages)))
+        max_in_flight = workers * 2 * self.batch_pages
+        logger.info(f"⚡ Analisi di {len(pages)} pagine con {workers} worker paralleli" + (f", fino a {self.batch_pages} pagine per chiamata" if self.batch_pages > 1 else ""))
+        in_flight = deque()
+        batch = []
+        # Nel resume le pagine vuote vanno davvero rianalizzate: la cache restituirebbe lo stesso risultato
+        use_cache = not resume
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"pages-{self.job_id}") as executor:
+            def flush_batch():
+                if batch:
+                    executor.submit(self._analyze_page_batch, list(batch), use_cache)
+                    batch.clear()
 
-        if self.db_manager: self.db_manager.update_job_status(self.job_id, "processing", 0, len(image_paths), "Inizio analisi immagini...")
-
-        for i, image_path in enumerate(image_paths):
-            print("\n" + "="*50)
-            logger.info(f"📊 Progresso: Pagina {i+1}/{len(image_paths)} - {Path(image_path).name}")
-            print("="*50)
-
-            progress_percent = (i + 1) * 100 // len(image_paths)
-            if self.db_manager: self.db_manager.update_job_status(self.job_id, "processing", progress_percent, len(image_paths), f"Analizzando pagina {i + 1}...")
-
-            extracted_products = self.analyze_with_gemini(image_path)
-
-            if extracted_products:
-                logger.info(f"🎉 Estratti {len(extracted_products)} prodotti da {Path(image_path).name}")
+            try:
+                try:
+                    for page_number, page_jpeg in self._checkpoint_pages(pdf_path, pages, resume):
+                        if self.batch_pages > 1:
+                            future = Future()
+                            batch.append((page_jpeg, future))
+                            if len(batch) >= min(self.batch_pages, gemini_batch_sizer.size()):
+                                flush_batch()
+                        else:
+                            future = executor.submit(self.analyze_with_gemini, page_jpeg, use_cache=use_cache)
+                        in_flight.append((page_number, page_jpeg, future))
+                        while len(in_flight) >= max_in_flight:
+                            flush_batch()
+                            all_extracted_products.extend(self._collect_page(in_flight.popleft(), total_pages))
+                except ExtractionCancelled:
+                    raise
+                except Exception as e:
+                    logger.error(f"❌ Errore conversione PDF: {e}")
+                flush_batch()
+                while in_flight:
+                    all_extracted_products.extend(self._collect_page(in_flight.popleft(), total_pages))
+            except ExtractionCancelled:
+                # Le pagine ancora in coda non vengono analizzate: si attendono solo le chiamate già partite
+                batch.clear()
+                for _, _, future in in_flight:
+                    future.cancel()
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+        total_products_extracted = sum(e["products"] for e in self.results_log.pages())
+        error_pages = self.error_pages()
+        if error_pages:
+            # Le pagine in errore restano nel checkpoint: il job va ripreso, non è completato
+            listed = ", ".join(map(str, error_pages[:10])) + (", ..." if len(error_pages) > 10 else "")
+            message = (f"{len(error_pages)} pagine su {total_pages} non analizzate ({listed}): "
+                       f"riprendi con POST /jobs/{self.job_id}/resume.")
+            logger.warning(f"⚠️ Elaborazione PDF incompleta: {message}")
+            if self.db_manager: self.db_manager.update_job_status(self.job_id, "failed", (total_pages - len(error_pages)) * 100 // total_pages, total_products_extracted, message)
+        else:
+            logger.info(f"✅ Elaborazione PDF completata. Totale prodotti estratti: {total_products_extracted}")
+            if self.db_manager: self.db_manager.update_job_status(self.job_id, "completed", 100, total_products_extracted, "Elaborazione completata.")
 
-                for prod_index, product in enumerate(extracted_products):
-                    product['pagina'] = i + 1
-                    # Aggiunge dettagli del job per tracciare i prodotti
-                    product['job_id'] = self.job_id
-                    product['supermercato'] = self.supermercato_nome
+        return all_extracted_products
 
-                    simulated_bbox = [0, 0, 100, 100]
-                    card_path = self.save_product_image(image_path, simulated_bbox, product, i + 1, prod_index + 1)
-                    product['immagine_prodotto_card'] = card_path or 'Non disponibile'
+    def _analyze_page_batch(self, items, use_cache=True):
+        """Analizza un gruppo di pagine e risolve il Future di ciascuna con i prodotti o l'errore."""
+        try:
+            results = self.analyze_pages_with_gemini([page_jpeg for page_jpeg, _ in items], use_cache=use_cache)
+        except Exception as e:
+            results = [e] * len(items)
+        for (_, future), result in zip(items, results):
+            if future.cancelled():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _checkpoint_pages(self, pdf_path, pages, resume):
+        """Pagine da analizzare: nel resume usa prima le immagini salvate nel checkpoint, poi renderizza le altre."""
+        to_render = pages
+        if resume:
+            to_render = []
+            for page_number in pages:
+                saved = self.temp_dir / f"page_{page_number}.jpg"
+                if saved.exists():
+                    yield page_number, saved.read_bytes()
+                else:
+                    to_render.append(page_number)
+        if to_render:
+            yield from self.iter_pdf_pages(pdf_path, to_render)
 
-                    db_id = self.save_product_to_db(product)
-                    if db_id: product['db_id'] = db_id
+    def error_pages(self):
+        """Pagine mancanti dal log o in errore."""
+        if self.total_pages is None:
+            return []
+        pages = {e["page"]: e["status"] for e in self.results_log.pages()}
+        return [p for p in range(1, self.total_pages + 1) if pages.get(p, "error") == "error"]
 
-                    all_extracted_products.append(product)
-                    total_products_extracted += 1
-            else:
-                logger.warning(f"😞 Nessun prodotto estratto da {Path(image_path).name}.")
-                self._save_original_image_fallback(image_path, i + 1)
+    def checkpoint_complete(self):
+        """True se tutte le pagine sono nel log senza errori (il checkpoint può essere rimosso).
 
-            if i < len(image_paths) - 1:
-                logger.info("⏳ Pausa di 5 secondi tra le immagini per il rate limiting...")
-                time.sleep(5)
+        Una pagina vuota è un risultato valido (es. copertina): non blocca la pulizia. Se il job ha
+        anche pagine in errore, il resume rianalizza pure le vuote, senza passare dalla cache.
+        """
+        return not self.error_pages()
+
+    def _reuse_previous_products(self, state):
+        """Volantino invariato: restituisce i prodotti dell'estrazione precedente senza chiamare Gemini."""
+        products = state['payload']
+        if self.on_page:
+            pages = {}
+            for product in products:
+                pages.setdefault(product.get('pagina') or 0, []).append(product)
+            total_pages = max(pages, default=0)
+            for page_number in sorted(pages):
+                self.on_page(page_number, total_pages, pages[page_number])
+        if self.db_manager: self.db_manager.update_job_status(self.job_id, "completed", 100, len(products), f"Volantino invariato: riutilizzati {len(products)} prodotti del job {state['job_id']}.")
+        return products
+
+    def _collect_page(self, item, total_pages):
+        """Attende l'analisi di una pagina, genera le card e salva i prodotti nel DB."""
+        page_number, page_jpeg, future = item
+        page_status = "ok"
+        try:
+            extracted_products = future.result()
+        except Exception as e:
+            logger.error(f"❌ Errore analisi pagina {page_number}: {e}")
+            extracted_products = []
+            page_status = "error"
 
-        logger.info(f"✅ Elaborazione PDF completata. Totale prodotti estratti: {total_products_extracted}")
+        print("\n" + "="*50)
+        logger.info(f"📊 Progresso: Pagina {page_number}/{total_pages}")
+        print("="*50)
 
-        if self.db_manager: self.db_manager.update_job_status(self.job_id, "completed", 100, total_products_extracted, "Elaborazione completata.")
+        progress_percent = page_number * 100 // total_pages
+        if self.db_manager: self.db_manager.update_job_status(self.job_id, "processing", progress_percent, total_pages, f"Analizzata pagina {page_number}...")
 
-        return all_extracted_products
+        if not extracted_products:
+            logger.warning(f"😞 Nessun prodotto estratto da pagina {page_number}.")
+            self._save_original_image_fallback(page_jpeg, page_number)
+            extracted_products = []
+        else:
+            logger.info(f"🎉 Estratti {len(extracted_products)} prodotti da pagina {page_number}")
+            card_paths = self.save_product_images(page_jpeg, extracted_products, page_number)
+            for product, card_path in zip(extracted_products, card_paths):
+                product['pagina'] = page_number
+                # Aggiunge dettagli del job per tracciare i prodotti
+                product['job_id'] = self.job_id
+                product['supermercato'] = self.supermercato_nome
+                product['immagine_prodotto_card'] = card_path or 'Non disponibile'
+                product['volantino_url'] = self.volantino.get('url')
+                product['volantino_name'] = self.volantino.get('name')
+                product['volantino_validita'] = self.volantino.get('validity')
+
+            self.save_products_to_db(extracted_products)
+
+        page_status = page_status if extracted_products or page_status == "error" else "empty"
+        if page_status != "ok":
+            # L'immagine della pagina fa parte del checkpoint: il resume la rianalizza senza renderizzarla di nuovo
+            try:
+                (self.temp_dir / f"page_{page_number}.jpg").write_bytes(page_jpeg)
+            except OSError as e:
+                logger.warning(f"⚠️ Impossibile salvare il checkpoint della pagina {page_number}: {e}")
+        metrics.inc("deco_pages_total", status=page_status)
+        self.results_log.append_page(page_number, extracted_products, page_status)
+        if self.on_page:
+            self.on_page(page_number, total_pages, extracted_products)
+        return extracted_products
 
     def cleanup_temp_files(self):
         """Pulisce i file temporanei"""
@@ -724,23 +2331,28 @@ Regole importanti:
         except Exception as e:
             logger.error(f"❌ Errore durante la pulizia dei file temporanei: {e}")
 
-    def run(self, pdf_source, source_type="url"):
-        """Metodo principale per avviare l'estrazione"""
-        logger.info(f"🚀 Avvio estrazione per job {self.job_id}")
+    def run(self, pdf_source, source_type="url", resume=False):
+        """Metodo principale per avviare l'estrazione (o riprenderla dal checkpoint con `resume`)"""
+        logger.info(f"🚀 {'Ripresa' if resume else 'Avvio'} estrazione per job {self.job_id}")
 
         try:
-            results = self.process_pdf(pdf_source, source_type)
-
-            output_file = f'gemini_results_{self.job_id}.json'
-            results_data = {
-                'timestamp': datetime.now().isoformat(),
-                'method': 'Gemini AI Extractor (Colab)',
-                'total_products': len(results),
-                'products': results
-            }
-
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(results_data, f, indent=2, ensure_ascii=False)
+            results = self.process_pdf(pdf_source, source_type, resume=resume)
+            if self.unchanged_state:
+                # Nessun nuovo file risultati: i prodotti sono già in quello del job precedente
+                return results
+
+            # Il JSON storico è una vista derivata dal log NDJSON scritto pagina per pagina
+            self.results_log.close()
+            output_file = results_file_path(self.job_id)
+            results = self.results_log.export_json(output_file)
+            results_catalog.record(self.job_id, output_file, results, self.volantino, self.supermercato_nome)
+            file_product_index.invalidate()
+            offer_index.mark_stale()
+            # Un'estrazione con pagine in errore non diventa lo stato noto del volantino (verrebbe riusata)
+            if flyer_state is not None and self.download_state and results and not self.error_pages():
+                flyer_state.put(self.download_state['url'], etag=self.download_state['etag'],
+                                last_modified=self.download_state['last_modified'],
+                                sha256=self.download_state['sha256'], job_id=self.job_id, payload=results)
 
             logger.info(f"\n==============================================")
             logger.info(f"💾 Risultati salvati in {output_file}")
@@ -748,13 +2360,28 @@ Regole importanti:
             logger.info(f"==============================================")
             return results
 
+        except ExtractionCancelled:
+            # Non è un errore: il job resta riprendibile dal checkpoint con le pagine già analizzate
+            logger.info(f"⏹️ Estrazione del job {self.job_id} interrotta.")
+            if self.db_manager:
+                analyzed = self.results_log.pages()
+                progress = len(analyzed) * 100 // self.total_pages if self.total_pages else 0
+                self.db_manager.update_job_status(self.job_id, "cancelled", progress, sum(e["products"] for e in analyzed), "Estrazione interrotta.")
+            raise
         except Exception as e:
             logger.error(f"❌ Errore fatale nel metodo RUN: {e}")
             if self.db_manager:
                  self.db_manager.update_job_status(self.job_id, "failed", 0, 0, f"Errore fatale: {e}")
             return []
         finally:
-            self.cleanup_temp_files()
+            self.results_log.close()
+            # In caso di pagine mancanti o in errore i file temporanei restano come checkpoint per il resume
+            if self.checkpoint_complete():
+                self.cleanup_temp_files()
+                self.results_log.remove_checkpoint()
+            else:
+                logger.warning(f"💾 Checkpoint conservato in {self.temp_dir}: riprendi con POST /jobs/{self.job_id}/resume")
+            prune_job_files()
 
 GeminiOnlyExtractor = MultiAIExtractor
 
@@ -766,6 +2393,20 @@ GeminiOnlyExtractor = MultiAIExtractor
 # ==============================================================================
 app = FastAPI(title="Deco Volantino Extractor API", version="1.0.0")
 
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    start = time.perf_counter()
+    status = "500"
+    try:
+        response = await call_next(request)
+        status = str(response.status_code)
+        return response
+    finally:
+        # Etichetta con il template della rotta (/results/{job_id}), non con il path concreto
+        route = request.scope.get("route")
+        metrics.observe("deco_http_request_seconds", time.perf_counter() - start, method=request.method,
+                        route=getattr(route, "path", "unmatched"), status=status)
+
 # Configurazione CORS per consentire richieste dal sito WordPress
 ALLOW_ORIGINS_ENV = os.getenv("ALLOW_ORIGINS")
 ALLOWED_ORIGINS = [o.strip() for o in ALLOW_ORIGINS_ENV.split(",") if o.strip()] if ALLOW_ORIGINS_ENV else ["http://volantino.local", "http://localhost", "http://localhost:3000"]
@@ -777,18 +2418,373 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-RESULTS_PATTERN = "gemini_results_*.json"
 IMAGES_DIR_ENV = os.getenv("IMAGES_DIR")
 DISK_PATH_ENV = os.getenv("DISK_PATH") or os.getenv("PERSISTENT_DISK_PATH")
 IMAGES_DIR = IMAGES_DIR_ENV or (os.path.join(DISK_PATH_ENV, "multi_ai_product_images") if DISK_PATH_ENV else "multi_ai_product_images")
 os.makedirs(IMAGES_DIR, exist_ok=True)
 
+# ------------------------------------------------------------------------------
+# INDICE IN MEMORIA DEI PRODOTTI (modalità senza DB)
+# ------------------------------------------------------------------------------
+PRODUCT_INDEX_CHECK_INTERVAL = float(os.getenv("PRODUCT_INDEX_CHECK_INTERVAL", "2"))
+
+class FileProductIndex:
+    """Indice in memoria dei prodotti dell'ultimo file di risultati, condiviso nel processo.
+
+    Il file viene letto una sola volta e ricaricato solo quando cambia (controllo al massimo ogni
+    PRODUCT_INDEX_CHECK_INTERVAL secondi). Per ogni prodotto conserva campi minuscoli e prezzo già
+    convertito, più lookup per marca/categoria/supermercato/job e un vocabolario per la ricerca fuzzy.
+    """
+    LOOKUP_FIELDS = ("marca", "categoria", "supermercato")
+
+    def __init__(self, check_interval=PRODUCT_INDEX_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.signature = None
+        self.last_check = 0.0
+        self.products = []
+        self.entries = []
+        self.lookups = {}
+        self.by_job = {}
+        self.words = {}
+        self.word_trigrams = {}
+        self.trigram_words = {}
+
+    def invalidate(self):
+        with self.lock:
+            self.last_check = 0.0
+
+    def _latest_signature(self):
+        latest = results_catalog.latest()
+        if not latest:
+            return None
+        return (latest["file"], latest["modified"], latest["size"])
+
+    def _load(self, signature):
+        products = []
+        if signature:
+            with open(signature[0], "r", encoding="utf-8") as f:
+                products = json.load(f).get("products", [])
+        entries, lookups, by_job, words = [], {f: {} for f in self.LOOKUP_FIELDS}, {}, {}
+        for pos, p in enumerate(products):
+            entry = {f: normalize_text(p.get(f)) for f in ("nome",) + self.LOOKUP_FIELDS}
+            entry["price"] = DBManagerSQLAlchemy._convert_price_to_float(p.get("prezzo"))
+            entry["search"] = product_search_text(p)
+            entries.append(entry)
+            for f in self.LOOKUP_FIELDS:
+                lookups[f].setdefault(entry[f], []).append(pos)
+            by_job.setdefault(p.get("job_id"), []).append(pos)
+            for word in set(entry["search"].split()):
+                words.setdefault(word, []).append(pos)
+        # Trigrammi del vocabolario calcolati una volta per caricamento, con indice invertito trigramma -> parole
+        word_trigrams = {word: _trigrams(word) for word in words}
+        trigram_words = {}
+        for word, tri in word_trigrams.items():
+            for t in tri:
+                trigram_words.setdefault(t, []).append(word)
+        self.products, self.entries, self.lookups, self.by_job, self.words = products, entries, lookups, by_job, words
+        self.word_trigrams, self.trigram_words = word_trigrams, trigram_words
+        self.signature = signature
+        logger.info(f"🗂️ Indice prodotti ricaricato: {len(products)} prodotti da {signature[0] if signature else 'nessun file'}")
+
+    def refresh(self):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_check < self.check_interval and self.signature is not None:
+                return
+            self.last_check = now
+            signature = self._latest_signature()
+            if signature != self.signature:
+                try:
+                    self._load(signature)
+                except Exception as e:
+                    logger.error(f"❌ Errore caricamento indice prodotti: {e}")
+
+    def _positions(self, marca=None, categoria=None, supermarket=None, job_id=None):
+        """Posizioni che soddisfano i filtri testuali, calcolate sui valori distinti dei lookup."""
+        selected = None
+        for field, needle in (("marca", marca), ("categoria", categoria), ("supermercato", supermarket)):
+            if not needle:
+                continue
+            needle = needle.lower()
+            matches = set()
+            for value, positions in self.lookups[field].items():
+                if needle in value:
+                    matches.update(positions)
+            selected = matches if selected is None else selected & matches
+        if job_id:
+            matches = set(self.by_job.get(job_id, []))
+            selected = matches if selected is None else selected & matches
+        return range(len(self.entries)) if selected is None else sorted(selected)
+
+    def _price_ok(self, pos, price_min, price_max):
+        price = self.entries[pos]["price"]
+        return (price_min is None or price >= price_min) and (price_max is None or price <= price_max)
+
+    def filter(self, marca=None, categoria=None, supermarket=None, job_id=None, q=None, price_min=None, price_max=None):
+        self.refresh()
+        q = q.lower() if q else None
+        return [self.products[pos] for pos in self._positions(marca, categoria, supermarket, job_id)
+                if (not q or q in self.entries[pos]["nome"]) and self._price_ok(pos, price_min, price_max)]
+
+    def search(self, q, threshold=FUZZY_MATCH_THRESHOLD, **filters):
+        """Come fuzzy_match_score, ma la similarità a trigrammi è calcolata solo per le parole del vocabolario
+        che condividono almeno un trigramma con la query (le altre hanno similarità zero)."""
+        self.refresh()
+        price_min, price_max = filters.pop("price_min", None), filters.pop("price_max", None)
+        allowed = self._positions(**filters)
+        q_norm = normalize_text(q)
+        q_words = q_norm.split()
+        if not q_words:
+            return []
+        best = {}
+        for q_word in q_words:
+            q_tri = _trigrams(q_word)
+            shared = {}
+            for t in q_tri:
+                for word in self.trigram_words.get(t, ()):
+                    shared[word] = shared.get(word, 0) + 1
+            scores = {}
+            for word, common in shared.items():
+                sim = common / (len(q_tri) + len(self.word_trigrams[word]) - common)
+                for pos in self.words[word]:
+                    if sim > scores.get(pos, 0.0):
+                        scores[pos] = sim
+            for pos, sim in scores.items():
+                best[pos] = best.get(pos, 0.0) + sim / len(q_words)
+        scored = []
+        for pos in allowed:
+            score = 1.0 if q_norm in self.entries[pos]["search"] else best.get(pos, 0.0)
+            if score >= threshold and self._price_ok(pos, price_min, price_max):
+                scored.append((score, pos))
+        scored.sort(key=lambda sp: sp[0], reverse=True)
+        return [self.products[pos] for _, pos in scored]
+
+file_product_index = FileProductIndex()
+
+# ------------------------------------------------------------------------------
+# INDICE INVERTITO DELLE OFFERTE PER /compare
+# ------------------------------------------------------------------------------
+OFFER_INDEX_SYNC_INTERVAL = float(os.getenv("OFFER_INDEX_SYNC_INTERVAL", "5"))
+OFFER_FIELDS = ("nome", "marca", "supermercato", "prezzo", "prezzo_float", "categoria", "immagine_prodotto_card", "job_id", "volantino_name", "volantino_validita")
+
+def compare_norm(s):
+    """Normalizzazione di /compare: solo lettere minuscole e cifre, spazi singoli."""
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", (s or "").lower()).split())
+
+class OfferIndex:
+    """Indice invertito delle offerte su nome normalizzato, aggiornato in modo incrementale.
+
+    Con il DB attivo carica solo le righe con id maggiore dell'ultimo sincronizzato; in modalità file
+    aggiunge i file di risultati nuovi (e ricostruisce se un file noto cambia). Per ogni parola del
+    nome mantiene le offerte che la contengono (più un indice dei nomi completi e uno a trigrammi del
+    vocabolario per le parole parziali), così /compare verifica solo i candidati invece dell'intero catalogo.
+    """
+    def __init__(self, sync_interval=OFFER_INDEX_SYNC_INTERVAL):
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.offers = []
+        self.names = []
+        self.brands = []
+        self.prices = []
+        self.word_postings = {}
+        self.pair_postings = {}
+        self.name_postings = {}
+        self.max_name_len = 0
+        self.vocab_trigrams = {}
+        self.expansions = {}
+        self.max_db_id = 0
+        self.files = {}
+        self.last_sync = 0.0
+
+    def mark_stale(self):
+        with self.lock:
+            self.last_sync = 0.0
+
+    def _add(self, p):
+        offer = {f: p.get(f) for f in OFFER_FIELDS}
+        if offer["prezzo_float"] is None:
+            offer["prezzo_float"] = DBManagerSQLAlchemy._convert_price_to_float(p.get("prezzo"))
+        nome_norm = compare_norm(p.get("nome"))
+        offer_id = len(self.offers)
+        self.offers.append(offer)
+        self.names.append(nome_norm)
+        self.brands.append(compare_norm(p.get("marca")))
+        self.prices.append(offer["prezzo_float"] or 0.0)
+        words = nome_norm.split()
+        for word in set(words):
+            postings = self.word_postings.get(word)
+            if postings is None:
+                postings = self.word_postings[word] = array("I")
+                for tri in _trigrams(word):
+                    self.vocab_trigrams.setdefault(tri, set()).add(word)
+                self.expansions.clear()
+            postings.append(offer_id)
+        for pair in set(zip(words, words[1:])):
+            self.pair_postings.setdefault(pair, array("I")).append(offer_id)
+        if words:
+            self.name_postings.setdefault(nome_norm, array("I")).append(offer_id)
+            self.max_name_len = max(self.max_name_len, len(nome_norm))
+
+    def _sync_db(self):
+        session = SessionLocal()
+        try:
+            columns = [getattr(Product, f) for f in OFFER_FIELDS]
+            rows = session.execute(
+                select(Product.id, *columns).where(Product.id > self.max_db_id).order_by(Product.id).execution_options(yield_per=5000)
+            )
+            added = 0
+            for row in rows:
+                self._add(row._mapping)
+                self.max_db_id = row.id
+                added += 1
+        finally:
+            session.close()
+        if added:
+            logger.info(f"🗂️ Indice offerte: +{added} prodotti dal DB (totale {len(self.offers)})")
+
+    def _sync_files(self):
+        current = {r["file"]: (r["modified"], r["size"]) for r in results_catalog.list()}
+        if any(current.get(fp) != sig for fp, sig in self.files.items()):
+            # Un file già indicizzato è cambiato o è stato rimosso: ricostruzione completa
+            self._reset()
+        for fp, sig in sorted(current.items()):
+            if fp in self.files:
+                continue
+            try:
+                with open(fp, "r", encoding="utf-8") as f:
+                    products = [p for p in json.load(f).get("products", []) if isinstance(p, dict)]
+            except Exception as e:
+                # Firma non registrata: il file viene ritentato alla sincronizzazione successiva
+                logger.warning(f"⚠️ Indice offerte: impossibile leggere {fp}: {e}")
+                continue
+            for p in products:
+                self._add(p)
+            self.files[fp] = sig
+
+    def sync(self):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_sync < self.sync_interval:
+                return
+            if DB_ENABLED and SessionLocal is not None:
+                self._sync_db()
+            else:
+                self._sync_files()
+            self.last_sync = time.monotonic()
+
+    def _words_containing(self, token):
+        words = self.expansions.get(token)
+        if words is None:
+            if len(token) < 3:
+                words = [w for w in self.word_postings if token in w]
+            else:
+                tris = sorted((self.vocab_trigrams.get(t, set()) for t in _trigrams(token) if " " not in t), key=len)
+                candidates = set.intersection(*tris) if tris else set()
+                words = [w for w in candidates if token in w]
+            self.expansions[token] = words
+        return words
+
+    # Sotto questa soglia i candidati vengono verificati direttamente invece di intersecare altri insiemi
+    VERIFY_THRESHOLD = 2000
+
+    def _candidates(self, qn):
+        """Offerte che possono soddisfare `qn in nome` oppure `nome in qn`."""
+        q_words = qn.split()
+        last = len(q_words) - 1
+        # qn in nome: la prima parola della query può essere la fine di una parola del nome, l'ultima
+        # l'inizio, quelle interne devono coincidere; con più parole si usano le coppie adiacenti
+        def expand(k):
+            token = q_words[k]
+            words = self._words_containing(token)
+            if k > 0 and k < last:
+                return [token] if token in self.word_postings else []
+            if k > 0:
+                return [w for w in words if w.startswith(token)]
+            if k < last:
+                return [w for w in words if w.endswith(token)]
+            return words
+
+        if last == 0:
+            groups = [[self.word_postings[w] for w in expand(0)]]
+        else:
+            expansions = [expand(k) for k in range(last + 1)]
+            groups = [[self.pair_postings[(a, b)] for a in expansions[k] for b in expansions[k + 1] if (a, b) in self.pair_postings]
+                      for k in range(last)]
+        groups.sort(key=lambda g: sum(len(postings) for postings in g))
+        candidates = set()
+        for i, group in enumerate(groups):
+            ids = set()
+            for postings in group:
+                ids.update(postings)
+            candidates = ids if i == 0 else candidates & ids
+            if len(candidates) <= self.VERIFY_THRESHOLD:
+                break
+        # nome in qn: ogni sottostringa della query che inizia e finisce con un carattere non spazio
+        # può essere un nome completo, anche dentro una parola più lunga ("orate" in "dorate")
+        size = len(qn)
+        for i in range(size):
+            if qn[i] == " ":
+                continue
+            for j in range(i + 1, min(size, i + self.max_name_len) + 1):
+                if qn[j - 1] != " ":
+                    postings = self.name_postings.get(qn[i:j])
+                    if postings:
+                        candidates.update(postings)
+        return candidates
+
+    def find_offers(self, nome, marca=None, limit=None):
+        """Offerte con prezzo valido che corrispondono a nome (e marca), dalla più economica."""
+        qn = compare_norm(nome)
+        qm = compare_norm(marca or "")
+        if not qn:
+            return []
+        with self.lock:
+            names, brands, prices = self.names, self.brands, self.prices
+            matched = [i for i in self._candidates(qn)
+                       if (qn in names[i] or names[i] in qn)
+                       and prices[i] > 0.0
+                       and (not qm or qm in brands[i] or brands[i] in qm)]
+            matched.sort(key=lambda i: (prices[i], i))
+            if limit is not None:
+                matched = matched[:limit]
+            return [dict(self.offers[i]) for i in matched]
+
+offer_index = OfferIndex()
+
 # Espone cartella immagini come static files (utile per card generate)
 app.mount("/images", StaticFiles(directory=IMAGES_DIR), name="images")
 
+image_store = ImageStore(IMAGES_DIR)
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+@app.get("/img/{name}")
+def get_image(name: str, request: Request, w: Optional[int] = None):
+    """Card dall'archivio per contenuto: /img/<sha256>.webp?w=320. Il contenuto di un URL non cambia mai."""
+    digest, _, ext = name.partition(".")
+    fmt = (ext or "jpg").lower()
+    if fmt not in IMAGE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Formato non supportato: usa {', '.join(IMAGE_FORMATS)}.")
+    if w is not None and w not in IMAGE_VARIANT_WIDTHS:
+        raise HTTPException(status_code=400, detail=f"Larghezza non ammessa: usa {IMAGE_VARIANT_WIDTHS}.")
+    etag = f'"{digest}-{w or 0}-{fmt}"'
+    headers = {"Cache-Control": IMAGE_CACHE_CONTROL, "ETag": etag}
+    if not image_store.exists(digest):
+        raise HTTPException(status_code=404, detail="Immagine non trovata.")
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    data = image_store.variant(digest, w, fmt)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Immagine non trovata.")
+    return Response(content=data, media_type=IMAGE_FORMATS[fmt][1], headers=headers)
+
 class ExtractRequest(BaseModel):
     url: str
     supermercato_nome: Optional[str] = "Supermercati Deco Arena"
+    force: bool = False
 
 # Nuovo modello per importare prodotti via JSON (Postman)
 class ImportRequest(BaseModel):
@@ -803,6 +2799,25 @@ class ImportRequest(BaseModel):
 def health():
     return {"status": "ok"}
 
+# Stato dello scheduler delle chiavi Gemini (budget, errori, quarantene) e del dimensionamento dei batch
+@app.get("/gemini/status")
+def gemini_status():
+    return {"keys": gemini_scheduler.status(), "batch": gemini_batch_sizer.info()}
+
+# Metriche in formato Prometheus (le chiavi Gemini sono etichettate per indice: key0, key1)
+@app.get("/metrics")
+def get_metrics():
+    metrics.set("deco_gemini_keys_quarantined", sum(1 for k in gemini_scheduler.status() if k["quarantined_for"] > 0))
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# Statistiche della cache dei risultati Gemini
+@app.get("/cache/stats")
+def cache_stats():
+    images = image_store.info()
+    if gemini_cache is None:
+        return {"enabled": False, "images": images}
+    return {"enabled": True, **gemini_cache.info(), "images": images}
+
 @app.get("/flyers")
 def get_flyers():
     scraper = DecoFlyerScraper()
@@ -812,52 +2827,97 @@ def get_flyers():
 # Elenco dei risultati disponibili
 @app.get("/results/list")
 def list_results():
-    files = sorted(glob.glob(RESULTS_PATTERN))
-    results = []
-    for fp in files:
-        try:
-            job_id = os.path.basename(fp).replace("gemini_results_", "").replace(".json", "")
-            mtime = os.path.getmtime(fp)
-            size = os.path.getsize(fp)
-            results.append({
-                "file": os.path.basename(fp),
-                "job_id": job_id,
-                "modified": mtime,
-                "size": size
-            })
-        except Exception:
-            continue
+    results = [{"file": os.path.basename(r["file"]), **{k: v for k, v in r.items() if k != "file"}}
+               for r in results_catalog.list()]
     return {"count": len(results), "results": results}
 
+def _result_file_response(entry):
+    # Il file viene inviato a blocchi dal disco, senza decodificare il JSON
+    if not os.path.exists(entry["file"]):
+        results_catalog.remove(entry["job_id"])
+        raise HTTPException(status_code=404, detail=f"Risultato non trovato per job_id {entry['job_id']}.")
+    return FileResponse(entry["file"], media_type="application/json")
+
 # Restituisce l'ultimo risultato (per data di modifica)
 @app.get("/results/latest")
 def get_latest_result():
-    files = glob.glob(RESULTS_PATTERN)
-    if not files:
+    latest = results_catalog.latest()
+    if not latest:
         raise HTTPException(status_code=404, detail="Nessun risultato disponibile.")
-    latest = max(files, key=lambda f: os.path.getmtime(f))
-    try:
-        with open(latest, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return data
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Errore lettura risultato: {str(e)}")
+    return _result_file_response(latest)
+
+# Prodotti di un job in streaming dal log NDJSON, eventualmente di una sola pagina
+@app.get("/results/{job_id}/products")
+def stream_result_products(job_id: str, page: Optional[int] = None):
+    log = ResultsLog(job_id)
+    if log.exists():
+        products = log.iter_products(page)
+    else:
+        # Log rimosso dalla retention: i prodotti vengono letti dal JSON esportato
+        entry = results_catalog.get(job_id)
+        if not entry or not os.path.exists(entry["file"]):
+            raise HTTPException(status_code=404, detail=f"Log dei risultati non trovato per job_id {job_id}.")
+        with open(entry["file"], "r", encoding="utf-8") as f:
+            products = [p for p in json.load(f).get("products", []) if page is None or p.get("pagina") == page]
+    lines = (json.dumps(p, ensure_ascii=False) + "\n" for p in products)
+    return StreamingResponse(lines, media_type="application/x-ndjson")
 
 # Restituisce il risultato per job_id specifico
 @app.get("/results/{job_id}")
 def get_result_by_job(job_id: str):
-    fp = f"gemini_results_{job_id}.json"
-    if not os.path.exists(fp):
+    entry = results_catalog.get(job_id)
+    if not entry:
         raise HTTPException(status_code=404, detail=f"Risultato non trovato per job_id {job_id}.")
+    return _result_file_response(entry)
+
+# ------------------------------------------------------------------------------
+# PAGINAZIONE A CURSORE E CONTEGGI
+# ------------------------------------------------------------------------------
+# Sotto questa stima il conteggio esatto costa poco e viene sempre calcolato (modalità "auto")
+COUNT_EXACT_THRESHOLD = int(os.getenv("COUNT_EXACT_THRESHOLD", "10000"))
+COUNT_MODES = ("auto", "exact", "estimated", "none")
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor):
     try:
-        with open(fp, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return data
+        return json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursore non valido.")
+
+def _estimate_count(session, query):
+    """Stima delle righe dal planner di Postgres (None se non disponibile)."""
+    if engine.dialect.name != "postgresql":
+        return None
+    try:
+        if query.whereclause is None:
+            return int(session.execute(text("SELECT reltuples::bigint FROM pg_class WHERE relname = 'products'")).scalar() or 0)
+        compiled = query.statement.compile(dialect=engine.dialect)
+        plan = session.connection().exec_driver_sql("EXPLAIN (FORMAT JSON) " + str(compiled), compiled.params).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Errore lettura risultato: {str(e)}")
+        logger.warning(f"⚠️ Stima conteggio non disponibile: {e}")
+        return None
+
+def count_products(session, query, mode):
+    """Restituisce (totale, è_stima) secondo la modalità: exact, estimated, none o auto (stima, esatto se piccolo)."""
+    if mode not in COUNT_MODES:
+        raise HTTPException(status_code=400, detail=f"count deve essere uno tra {', '.join(COUNT_MODES)}.")
+    if mode == "none":
+        return None, False
+    if mode in ("auto", "estimated"):
+        estimate = _estimate_count(session, query)
+        if estimate is not None and (mode == "estimated" or estimate >= COUNT_EXACT_THRESHOLD):
+            return estimate, True
+    return query.count(), False
 
 @app.get("/products")
-def list_products(page: int = 1, page_size: int = 20, marca: Optional[str] = None, categoria: Optional[str] = None, supermarket: Optional[str] = None, job_id: Optional[str] = None, q: Optional[str] = None, price_min: Optional[float] = None, price_max: Optional[float] = None):
+def list_products(page: int = 1, page_size: int = 20, marca: Optional[str] = None, categoria: Optional[str] = None, supermarket: Optional[str] = None, job_id: Optional[str] = None, q: Optional[str] = None, price_min: Optional[float] = None, price_max: Optional[float] = None, cursor: Optional[str] = None, count: str = "auto"):
+    # Con `cursor` (valore di next_cursor della risposta precedente) la pagina è letta in keyset su
+    # (created_at, id) invece che con OFFSET; page/page_size restano supportati per compatibilità.
     if DB_ENABLED and SessionLocal is not None:
         session = SessionLocal()
         try:
@@ -876,8 +2936,18 @@ def list_products(page: int = 1, page_size: int = 20, marca: Optional[str] = Non
                 query = query.filter(Product.prezzo_float >= price_min)
             if price_max is not None:
                 query = query.filter(Product.prezzo_float <= price_max)
-            total = query.count()
-            items = query.order_by(Product.created_at.desc()).offset((page-1)*page_size).limit(page_size).all()
+            total, total_is_estimate = count_products(session, query, count)
+            query = query.order_by(Product.created_at.desc(), Product.id.desc())
+            if cursor:
+                try:
+                    created_at, last_id = decode_cursor(cursor)
+                    created_at, last_id = datetime.fromisoformat(created_at), int(last_id)
+                except (TypeError, ValueError):
+                    raise HTTPException(status_code=400, detail="Cursore non valido.")
+                query = query.filter(tuple_(Product.created_at, Product.id) < tuple_(created_at, last_id))
+            else:
+                query = query.offset((page-1)*page_size)
+            items = query.limit(page_size).all()
             products = []
             for p in items:
                 products.append({
@@ -897,32 +2967,25 @@ def list_products(page: int = 1, page_size: int = 20, marca: Optional[str] = Non
                     "volantino_validita": p.volantino_validita,
                     "created_at": p.created_at.isoformat() if p.created_at else None
                 })
-            return {"page": page, "page_size": page_size, "total": total, "products": products}
+            next_cursor = None
+            if len(items) == page_size and items[-1].created_at is not None:
+                next_cursor = encode_cursor([items[-1].created_at.isoformat(), items[-1].id])
+            return {"page": page, "page_size": page_size, "total": total, "total_is_estimate": total_is_estimate, "next_cursor": next_cursor, "products": products}
         finally:
             session.close()
     else:
-        files = glob.glob(RESULTS_PATTERN)
-        if not files:
+        filtered = file_product_index.filter(marca=marca, categoria=categoria, supermarket=supermarket, job_id=job_id, q=q, price_min=price_min, price_max=price_max)
+        if not file_product_index.signature:
             return {"page": 1, "page_size": 0, "total": 0, "products": []}
-        latest = max(files, key=lambda f: os.path.getmtime(f))
-        with open(latest, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        products = data.get("products", [])
-        def match(p):
-            if marca and marca.lower() not in (p.get("marca","") or "").lower(): return False
-            if categoria and categoria.lower() not in (p.get("categoria","") or "").lower(): return False
-            if supermarket and supermarket.lower() not in (p.get("supermercato","") or "").lower(): return False
-            if job_id and job_id != p.get("job_id"): return False
-            if q and q.lower() not in (p.get("nome","") or "").lower(): return False
-            prf = DBManagerSQLAlchemy._convert_price_to_float(p.get("prezzo")) if hasattr(DBManagerSQLAlchemy, "_convert_price_to_float") else 0.0
-            if price_min is not None and prf < price_min: return False
-            if price_max is not None and prf > price_max: return False
-            return True
-        filtered = [p for p in products if match(p)]
-        total = len(filtered)
-        start = (page-1)*page_size
+        total = len(filtered) if count != "none" else None
+        # In modalità file il cursore è la posizione nell'elenco filtrato
+        try:
+            start = int(decode_cursor(cursor)[0]) if cursor else (page-1)*page_size
+        except (TypeError, ValueError, IndexError, KeyError):
+            raise HTTPException(status_code=400, detail="Cursore non valido.")
         end = start + page_size
-        return {"page": page, "page_size": page_size, "total": total, "products": filtered[start:end]}
+        next_cursor = encode_cursor([end]) if end < len(filtered) else None
+        return {"page": page, "page_size": page_size, "total": total, "total_is_estimate": False, "next_cursor": next_cursor, "products": filtered[start:end]}
 
 @app.get("/products/latest")
 def products_latest(page_size: int = 20):
@@ -939,96 +3002,15 @@ class CompareRequest(BaseModel):
 @app.post("/compare")
 def compare_prices(req: CompareRequest):
     """Confronta i prodotti del carrello con tutti i volantini e restituisce la migliore offerta per ciascun prodotto."""
-    # Helper per normalizzare stringhe
-    def norm(s: str) -> str:
-        import re
-        return " ".join(re.sub(r"[^a-z0-9]+", " ", (s or "").lower()).split())
-
-    def price_to_float(p):
-        try:
-            return DBManagerSQLAlchemy._convert_price_to_float(p)
-        except Exception:
-            try:
-                import re
-                m = re.search(r"([0-9]+[\.,][0-9]+|[0-9]+)", str(p or ""))
-                if m:
-                    return float(m.group(1).replace(',', '.'))
-            except Exception:
-                pass
-        return 0.0
-
-    # Carica tutti i prodotti disponibili (DB o file locali)
-    products: List[Dict[str, Any]] = []
-    if DB_ENABLED and SessionLocal is not None:
-        session = SessionLocal()
-        try:
-            items = session.query(Product).all()
-            for p in items:
-                products.append({
-                    "db_id": p.id,
-                    "job_id": p.job_id,
-                    "nome": p.nome,
-                    "marca": p.marca,
-                    "categoria": p.categoria,
-                    "prezzo": p.prezzo,
-                    "prezzo_float": p.prezzo_float,
-                    "descrizione": p.descrizione,
-                    "pagina": p.pagina,
-                    "supermercato": p.supermercato,
-                    "immagine_prodotto_card": p.immagine_prodotto_card,
-                    "volantino_url": p.volantino_url,
-                    "volantino_name": p.volantino_name,
-                    "volantino_validita": p.volantino_validita,
-                    "created_at": p.created_at.isoformat() if p.created_at else None
-                })
-        finally:
-            session.close()
-    else:
-        files = glob.glob(RESULTS_PATTERN)
-        for fp in files:
-            try:
-                with open(fp, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                for p in data.get("products", []):
-                    products.append(p)
-            except Exception:
-                continue
-
-    # Indicizza per confronto veloce
-    for p in products:
-        p.setdefault("prezzo_float", price_to_float(p.get("prezzo")))
-        p["_nome_norm"] = norm(p.get("nome", ""))
-        p["_marca_norm"] = norm(p.get("marca", ""))
+    offer_index.sync()
 
     results_items = []
     best_total = 0.0
 
     for item in req.items:
-        qn = norm(item.nome)
-        qm = norm(item.marca or "")
-        # Trova offerte corrispondenti: match su nome (sottostringa) e, se marca fornita, preferenza matching marca
-        offers = []
-        for p in products:
-            nome_ok = (qn in p["_nome_norm"]) or (p["_nome_norm"] in qn)
-            marca_ok = True
-            if qm:
-                marca_ok = (qm in p["_marca_norm"]) or (p["_marca_norm"] in qm)
-            if nome_ok and marca_ok:
-                offers.append({
-                    "nome": p.get("nome"),
-                    "marca": p.get("marca"),
-                    "supermercato": p.get("supermercato"),
-                    "prezzo": p.get("prezzo"),
-                    "prezzo_float": p.get("prezzo_float", 0.0),
-                    "categoria": p.get("categoria"),
-                    "immagine_prodotto_card": p.get("immagine_prodotto_card"),
-                    "job_id": p.get("job_id"),
-                    "volantino_name": p.get("volantino_name"),
-                    "volantino_validita": p.get("volantino_validita"),
-                })
-        # Ordina per prezzo e seleziona migliore
-        offers = [o for o in offers if (o.get("prezzo_float") or 0.0) > 0.0]
-        offers.sort(key=lambda o: o.get("prezzo_float", 1e9))
+        # Offerte corrispondenti: match su nome (sottostringa) e, se marca fornita, anche sulla marca
+        # (solo prezzi validi, ordinate per prezzo: la prima è la migliore)
+        offers = offer_index.find_offers(item.nome, item.marca, limit=20)
         best = offers[0] if offers else None
         if best:
             qty = item.qty or 1
@@ -1046,19 +3028,34 @@ def compare_prices(req: CompareRequest):
     }
 
 @app.get("/search")
-def search_products(q: str, page: int = 1, page_size: int = 20, marca: Optional[str] = None, categoria: Optional[str] = None, supermarket: Optional[str] = None, job_id: Optional[str] = None, price_min: Optional[float] = None, price_max: Optional[float] = None):
+def search_products(q: str, page: int = 1, page_size: int = 20, marca: Optional[str] = None, categoria: Optional[str] = None, supermarket: Optional[str] = None, job_id: Optional[str] = None, price_min: Optional[float] = None, price_max: Optional[float] = None, count: str = "auto"):
     # Ricerca testuale su nome, marca, categoria, descrizione + filtri opzionali.
     if DB_ENABLED and SessionLocal is not None:
         from sqlalchemy import or_  # import locale per minimizzare modifiche globali
         session = SessionLocal()
         try:
             query = session.query(Product)
-            query = query.filter(or_(
-                Product.nome.ilike(f"%{q}%"),
-                Product.marca.ilike(f"%{q}%"),
-                Product.categoria.ilike(f"%{q}%"),
-                Product.descrizione.ilike(f"%{q}%")
-            ))
+            q_norm = normalize_text(q)
+            if engine.dialect.name == "postgresql":
+                # tsvector italiano per parole/stemming, trigrammi per sottostringhe e refusi (indici GIN)
+                ts_query = func.websearch_to_tsquery('italian', q)
+                ts_vector = func.to_tsvector('italian', func.coalesce(Product.search_text, ''))
+                predicates = [ts_vector.op('@@')(ts_query), Product.search_text.ilike(f"%{q_norm}%")]
+                rank = func.ts_rank_cd(ts_vector, ts_query)
+                if PG_TRGM_AVAILABLE:
+                    predicates.append(Product.search_text.op('%>')(q_norm))
+                    rank = rank + func.word_similarity(q_norm, Product.search_text)
+                query = query.filter(or_(*predicates))
+                order_by = (rank.desc(), Product.created_at.desc(), Product.id.desc())
+            else:
+                query = query.filter(or_(
+                    Product.search_text.ilike(f"%{q_norm}%"),
+                    Product.nome.ilike(f"%{q}%"),
+                    Product.marca.ilike(f"%{q}%"),
+                    Product.categoria.ilike(f"%{q}%"),
+                    Product.descrizione.ilike(f"%{q}%")
+                ))
+                order_by = (Product.created_at.desc(), Product.id.desc())
             if marca:
                 query = query.filter(Product.marca.ilike(f"%{marca}%"))
             if categoria:
@@ -1071,8 +3068,8 @@ def search_products(q: str, page: int = 1, page_size: int = 20, marca: Optional[
                 query = query.filter(Product.prezzo_float >= price_min)
             if price_max is not None:
                 query = query.filter(Product.prezzo_float <= price_max)
-            total = query.count()
-            items = query.order_by(Product.created_at.desc()).offset((page-1)*page_size).limit(page_size).all()
+            total, total_is_estimate = count_products(session, query, count)
+            items = query.order_by(*order_by).offset((page-1)*page_size).limit(page_size).all()
             products = []
             for p in items:
                 products.append({
@@ -1092,64 +3089,55 @@ def search_products(q: str, page: int = 1, page_size: int = 20, marca: Optional[
                     "volantino_validita": p.volantino_validita,
                     "created_at": p.created_at.isoformat() if p.created_at else None
                 })
-            return {"page": page, "page_size": page_size, "total": total, "products": products}
+            return {"page": page, "page_size": page_size, "total": total, "total_is_estimate": total_is_estimate, "products": products}
         finally:
             session.close()
     else:
-        files = glob.glob(RESULTS_PATTERN)
-        if not files:
+        # Ordinamento per pertinenza (sottostringa prima, poi somiglianza a trigrammi)
+        filtered = file_product_index.search(q, marca=marca, categoria=categoria, supermarket=supermarket, job_id=job_id, price_min=price_min, price_max=price_max)
+        if not file_product_index.signature:
             return {"page": 1, "page_size": 0, "total": 0, "products": []}
-        latest = max(files, key=lambda f: os.path.getmtime(f))
-        with open(latest, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        products = data.get("products", [])
-        def match(p):
-            text_fields = [
-                (p.get("nome", "") or ""),
-                (p.get("marca", "") or ""),
-                (p.get("categoria", "") or ""),
-                (p.get("descrizione", "") or "")
-            ]
-            if not any(q.lower() in tf.lower() for tf in text_fields):
-                return False
-            if marca and marca.lower() not in (p.get("marca","") or "").lower(): return False
-            if categoria and categoria.lower() not in (p.get("categoria","") or "").lower(): return False
-            if supermarket and supermarket.lower() not in (p.get("supermercato","") or "").lower(): return False
-            if job_id and job_id != p.get("job_id"): return False
-            prf = DBManagerSQLAlchemy._convert_price_to_float(p.get("prezzo")) if hasattr(DBManagerSQLAlchemy, "_convert_price_to_float") else 0.0
-            if price_min is not None and prf < price_min: return False
-            if price_max is not None and prf > price_max: return False
-            return True
-        filtered = [p for p in products if match(p)]
-        total = len(filtered)
+        total = len(filtered) if count != "none" else None
         start = (page-1)*page_size
         end = start + page_size
-        return {"page": page, "page_size": page_size, "total": total, "products": filtered[start:end]}
+        return {"page": page, "page_size": page_size, "total": total, "total_is_estimate": False, "products": filtered[start:end]}
 
-@app.post("/extract")
-def extract(req: ExtractRequest):
-    if not os.getenv('GEMINI_API_KEY'):
-        raise HTTPException(status_code=500, detail="GEMINI_API_KEY non impostata nel server.")
+def _run_extract_job(job_id, url, supermercato_nome, force=False):
     db_mgr = get_db_manager()
     extractor = MultiAIExtractor(
         gemini_api_key=os.getenv('GEMINI_API_KEY'),
         gemini_api_key_2=os.getenv('GEMINI_API_KEY_2'),
-        job_id=str(int(time.time())),
+        job_id=job_id,
         db_manager=db_mgr,
-        supermercato_nome=req.supermercato_nome
+        supermercato_nome=supermercato_nome,
+        volantino={"url": url},
+        force_refresh=force
     )
-    results = extractor.run(pdf_source=req.url, source_type="url")
-    for product in results:
-        product['volantino_url'] = req.url
+    results = extractor.run(pdf_source=url, source_type="url")
     return {"job_id": extractor.job_id, "total_products": len(results), "products": results}
 
+def _submit_job(job_id, kind, func, params):
+    try:
+        return job_manager.submit(job_id, kind, func, params=params)
+    except JobQueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+@app.post("/extract", status_code=202)
+def extract(req: ExtractRequest):
+    if not os.getenv('GEMINI_API_KEY'):
+        raise HTTPException(status_code=500, detail="GEMINI_API_KEY non impostata nel server.")
+    job_id = new_job_id()
+    job = _submit_job(job_id, "extract", lambda: _run_extract_job(job_id, req.url, req.supermercato_nome, req.force),
+                      {"url": req.url, "supermercato_nome": req.supermercato_nome, "force": req.force})
+    return {"job_id": job_id, "status": job["status"], "status_url": f"/jobs/{job_id}"}
+
 # Importazione prodotti via JSON (body raw)
 @app.post("/import")
 def import_products(req: ImportRequest):
     db_mgr = get_db_manager()
     if not req.products:
         raise HTTPException(status_code=400, detail="Il body deve contenere la chiave 'products' con una lista di prodotti.")
-    job_id = req.job_id or f"import_{int(time.time())}"
+    job_id = req.job_id or new_job_id("import_")
     products = req.products
     for p in products:
         if req.supermercato_nome and not p.get("supermercato"):
@@ -1183,7 +3171,7 @@ async def import_products_file(
     products = data.get("products") if isinstance(data, dict) else (data if isinstance(data, list) else None)
     if not products or not isinstance(products, list):
         raise HTTPException(status_code=400, detail="Il file deve contenere 'products' come lista oppure essere una lista di prodotti.")
-    job = job_id or f"import_{int(time.time())}"
+    job = job_id or new_job_id("import_")
     for p in products:
         if supermercato_nome and not p.get("supermercato"):
             p["supermercato"] = supermercato_nome
@@ -1196,33 +3184,220 @@ async def import_products_file(
     saved = db_mgr.save_products(job, products)
     return {"job_id": job, "imported": len(saved), "products": saved}
 
-@app.get("/extract_all")
-def extract_all(limit: Optional[int] = None, supermercato_nome: Optional[str] = "Supermercati Deco Arena"):
-    if not os.getenv('GEMINI_API_KEY'):
-        raise HTTPException(status_code=500, detail="GEMINI_API_KEY non impostata nel server.")
-    scraper = DecoFlyerScraper()
-    flyers = scraper.scrape_flyers()
-    if limit is not None:
-        flyers = flyers[:limit]
+# Volantini elaborati in parallelo da /extract_all; il budget Gemini resta quello condiviso di gemini_scheduler
+EXTRACT_ALL_CONCURRENCY = max(1, int(os.getenv("EXTRACT_ALL_CONCURRENCY", "3")))
 
-    all_results = []
-    for i, flyer in enumerate(flyers):
-        db_mgr = get_db_manager()
+def _extract_flyer(flyer_job_id, flyer, supermercato_nome, force=False):
+    """Estrae un singolo volantino. Gli errori restano confinati al volantino e non fermano gli altri."""
+    try:
         extractor = MultiAIExtractor(
             gemini_api_key=os.getenv('GEMINI_API_KEY'),
             gemini_api_key_2=os.getenv('GEMINI_API_KEY_2'),
-            job_id=f"service_{int(time.time())}_{i+1}",
-            db_manager=db_mgr,
-            supermercato_nome=supermercato_nome
+            job_id=flyer_job_id,
+            db_manager=get_db_manager(),
+            supermercato_nome=supermercato_nome,
+            volantino=flyer,
+            force_refresh=force
         )
-        extracted_products = extractor.run(pdf_source=flyer['url'], source_type="url")
-        for product in extracted_products:
-            product['volantino_name'] = flyer.get('name')
-            product['volantino_validita'] = flyer.get('validity')
-            product['volantino_url'] = flyer.get('url')
-        all_results.extend(extracted_products)
-
-    return {"count": len(all_results), "products": all_results}
+        return extractor.run(pdf_source=flyer['url'], source_type="url")
+    except Exception as e:
+        logger.error(f"❌ Errore nel volantino {flyer.get('name')}: {e}")
+        job_manager.update(flyer_job_id, "failed", 0, 0, f"Errore: {e}")
+        return []
+
+def _run_extract_all_job(job_id, limit, supermercato_nome, force=False):
+    scraper = DecoFlyerScraper()
+    flyers = scraper.scrape_flyers(force=force)
+    if limit is not None:
+        flyers = flyers[:limit]
+    if not flyers:
+        return {"count": 0, "total_products": 0, "products": []}
+
+    flyer_job_ids = [f"{job_id}_{i+1}" for i in range(len(flyers))]
+    for flyer, flyer_job_id in zip(flyers, flyer_job_ids):
+        job_manager.update(flyer_job_id, "queued", 0, 0, f"Volantino {flyer.get('name')} in coda.", parent_id=job_id)
+
+    results = [[] for _ in flyers]
+    done = total = 0
+    workers = min(EXTRACT_ALL_CONCURRENCY, len(flyers))
+    logger.info(f"🗂️ Estrazione di {len(flyers)} volantini con {workers} in parallelo.")
+    job_manager.update(job_id, "processing", 0, 0, f"Volantini 0/{len(flyers)} completati")
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"flyers-{job_id}") as pool:
+        futures = {pool.submit(_extract_flyer, flyer_job_id, flyer, supermercato_nome, force): i
+                   for i, (flyer, flyer_job_id) in enumerate(zip(flyers, flyer_job_ids))}
+        for future in as_completed(futures):
+            i = futures[future]
+            results[i] = future.result()
+            done += 1
+            total += len(results[i])
+            job_manager.update(job_id, "processing", done * 100 // len(flyers), total,
+                               f"Volantini {done}/{len(flyers)} completati (ultimo: {flyers[i].get('name')})")
+
+    # Ordine dei prodotti stabile: quello dei volantini, indipendentemente dall'ordine di completamento
+    all_results = [product for flyer_products in results for product in flyer_products]
+    return {"count": len(all_results), "total_products": len(all_results), "products": all_results}
+
+@app.get("/extract_all", status_code=202)
+def extract_all(limit: Optional[int] = None, supermercato_nome: Optional[str] = "Supermercati Deco Arena", force: bool = False):
+    if not os.getenv('GEMINI_API_KEY'):
+        raise HTTPException(status_code=500, detail="GEMINI_API_KEY non impostata nel server.")
+    job_id = new_job_id("service_")
+    job = _submit_job(job_id, "extract_all", lambda: _run_extract_all_job(job_id, limit, supermercato_nome, force),
+                      {"limit": limit, "supermercato_nome": supermercato_nome, "force": force})
+    return {"job_id": job_id, "status": job["status"], "status_url": f"/jobs/{job_id}"}
+
+# Variante in streaming: eventi di avanzamento e prodotti pagina per pagina (NDJSON o Server-Sent Events)
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "64"))
+
+class StreamClosed(ExtractionCancelled):
+    """Il client dello stream si è disconnesso: l'estrazione in corso viene interrotta."""
+
+class ClosingStreamingResponse(StreamingResponse):
+    """StreamingResponse che chiama `on_close` a fine risposta, anche se il client si disconnette.
+
+    Il `finally` di un generatore sincrono non basta: Starlette lo itera in un threadpool e, alla
+    disconnessione, smette di chiamarlo senza chiuderlo.
+    """
+    def __init__(self, content, on_close, **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.on_close()
+
+def _stream_extract_all(job_id, events, closed, limit, supermercato_nome, force=False):
+    """Produttore (job del job_manager): esegue l'estrazione e accoda gli eventi. La coda limitata applica backpressure."""
+    def emit(event, **data):
+        while True:
+            if closed.is_set():
+                raise StreamClosed()
+            try:
+                events.put({"event": event, **data}, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    grand_total = 0
+    try:
+        # Il client può essersi già disconnesso mentre il job era in coda
+        if closed.is_set():
+            raise StreamClosed()
+        flyers = DecoFlyerScraper().scrape_flyers(force=force)
+        if limit is not None:
+            flyers = flyers[:limit]
+        emit("flyers", count=len(flyers), flyers=flyers)
+        for i, flyer in enumerate(flyers):
+            emit("flyer_start", index=i + 1, name=flyer.get('name'), url=flyer.get('url'))
+            job_manager.update(f"{job_id}_{i+1}", "queued", 0, 0, f"Volantino {flyer.get('name')} in coda.", parent_id=job_id)
+            extractor = MultiAIExtractor(
+                gemini_api_key=os.getenv('GEMINI_API_KEY'),
+                gemini_api_key_2=os.getenv('GEMINI_API_KEY_2'),
+                job_id=f"{job_id}_{i+1}",
+                db_manager=get_db_manager(),
+                supermercato_nome=supermercato_nome,
+                volantino=flyer,
+                force_refresh=force,
+                on_page=lambda page, total_pages, products, i=i: emit(
+                    "page", flyer_index=i + 1, page=page, total_pages=total_pages, products=products),
+            )
+            flyer_products = extractor.run(pdf_source=flyer['url'], source_type="url")
+            if closed.is_set():
+                raise StreamClosed()
+            grand_total += len(flyer_products)
+            emit("flyer_done", index=i + 1, job_id=extractor.job_id, total_products=len(flyer_products))
+        emit("done", total_products=grand_total)
+    except StreamClosed:
+        logger.info("ℹ️ Client dello stream disconnesso: estrazione interrotta.")
+        job_manager.update(job_id, "cancelled", 0, grand_total, "Client dello stream disconnesso.")
+    except Exception as e:
+        logger.error(f"❌ Errore nello stream di estrazione: {e}")
+        job_manager.update(job_id, "failed", 0, grand_total, f"Errore: {e}")
+        try:
+            emit("error", detail=str(e))
+        except StreamClosed:
+            pass
+    finally:
+        # Fine dello stream: il segnale non va perso se la coda è piena, finché il client è connesso
+        while not closed.is_set():
+            try:
+                events.put(None, timeout=1)
+                break
+            except queue.Full:
+                continue
+    return {"total_products": grand_total}
+
+@app.get("/extract_all/stream")
+def extract_all_stream(limit: Optional[int] = None, supermercato_nome: Optional[str] = "Supermercati Deco Arena", format: str = "ndjson", force: bool = False):
+    if not os.getenv('GEMINI_API_KEY'):
+        raise HTTPException(status_code=500, detail="GEMINI_API_KEY non impostata nel server.")
+    if format not in ("ndjson", "sse"):
+        raise HTTPException(status_code=400, detail="format deve essere 'ndjson' o 'sse'.")
+    events = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+    closed = threading.Event()
+    # Il produttore gira sul pool del job_manager: stessi limiti (JOB_WORKERS, JOB_QUEUE_LIMIT → 503) degli altri job
+    job_id = new_job_id("stream_")
+    _submit_job(job_id, "extract_all_stream", lambda: _stream_extract_all(job_id, events, closed, limit, supermercato_nome, force),
+                {"limit": limit, "supermercato_nome": supermercato_nome, "force": force, "format": format})
+
+    def body():
+        while True:
+            try:
+                item = events.get(timeout=15)
+            except queue.Empty:
+                # Keep-alive per proxy e client durante le pagine lente (anche mentre il job è in coda)
+                yield ": keep-alive\n\n" if format == "sse" else "\n"
+                continue
+            if item is None:
+                break
+            data = json.dumps(item, ensure_ascii=False)
+            yield f"event: {item['event']}\ndata: {data}\n\n" if format == "sse" else data + "\n"
+
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    # A fine risposta (completata o client disconnesso) il produttore si ferma e libera il worker
+    return ClosingStreamingResponse(body(), closed.set, media_type=media_type, headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Job-Id": job_id})
+
+# Stato dei job di estrazione in background
+@app.get("/jobs")
+def list_jobs():
+    jobs = job_manager.list()
+    return {"count": len(jobs), "jobs": jobs}
+
+def _run_resume_job(job_id, checkpoint):
+    extractor = MultiAIExtractor(
+        gemini_api_key=os.getenv('GEMINI_API_KEY'),
+        gemini_api_key_2=os.getenv('GEMINI_API_KEY_2'),
+        job_id=job_id,
+        db_manager=get_db_manager(),
+        supermercato_nome=checkpoint.get("supermercato_nome") or "SUPERMERCATO",
+        volantino=checkpoint.get("volantino"),
+        force_refresh=True
+    )
+    results = extractor.run(pdf_source=checkpoint["pdf_source"], source_type=checkpoint.get("source_type", "url"), resume=True)
+    return {"job_id": job_id, "total_products": len(results), "products": results}
+
+@app.post("/jobs/{job_id}/resume", status_code=202)
+def resume_job(job_id: str):
+    """Riprende un job di estrazione dal checkpoint: rielabora solo le pagine mancanti, vuote o in errore."""
+    if not os.getenv('GEMINI_API_KEY'):
+        raise HTTPException(status_code=500, detail="GEMINI_API_KEY non impostata nel server.")
+    checkpoint = ResultsLog(job_id).read_checkpoint()
+    if not checkpoint:
+        raise HTTPException(status_code=404, detail=f"Nessun checkpoint per il job {job_id}.")
+    current = job_manager.get(job_id, include_result=False)
+    if current and current["status"] not in JobManager.TERMINAL_STATUSES:
+        raise HTTPException(status_code=409, detail=f"Il job {job_id} è ancora in esecuzione.")
+    job = _submit_job(job_id, "resume", lambda: _run_resume_job(job_id, checkpoint), {"resume": True})
+    return {"job_id": job_id, "status": job["status"], "status_url": f"/jobs/{job_id}"}
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str, include_products: bool = True):
+    job = job_manager.get(job_id, include_result=include_products)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} non trovato.")
+    return job
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "8000"))
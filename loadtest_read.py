@@ -0,0 +1,341 @@
+"""Load test degli endpoint di lettura su cataloghi sintetici di grandi dimensioni.
+
+Genera cataloghi riproducibili (nomi, marche, categorie e prezzi in stile volantino italiano),
+li carica in modalità file (gemini_results_*.json) e/o DB (modello Product, Postgres o SQLite),
+avvia il servizio con uvicorn e lo interroga in parallelo su /products, /products/latest,
+/search e /compare, riportando throughput e percentili di latenza per scenario.
+
+Esempi:
+    python loadtest_read.py --size 10000 --mode file
+    python loadtest_read.py --size 100000 --mode db --database-url postgresql+psycopg2://u:p@localhost/deco
+    python loadtest_read.py --size 10000 --size 100000 --size 1000000 --mode both --concurrency 16 --duration 30
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CATALOG = {
+    "Pasta": (["Spaghetti", "Penne rigate", "Fusilli", "Rigatoni", "Linguine", "Farfalle", "Orecchiette", "Paccheri"],
+              ["Barilla", "De Cecco", "Garofalo", "Rummo", "Divella", "Voiello"]),
+    "Latticini": (["Mozzarella", "Ricotta", "Stracchino", "Yogurt bianco", "Burro", "Latte intero", "Parmigiano Reggiano", "Mascarpone"],
+                  ["Granarolo", "Galbani", "Parmalat", "Zymil", "Santa Lucia", "Vallelata"]),
+    "Salumi": (["Prosciutto cotto", "Prosciutto crudo", "Salame Milano", "Mortadella", "Bresaola", "Speck"],
+               ["Rovagnati", "Citterio", "Beretta", "Negroni", "Fiorucci", "Levoni"]),
+    "Bevande": (["Acqua naturale", "Acqua frizzante", "Aranciata", "Succo di pesca", "Birra lager", "Tè al limone"],
+                ["San Benedetto", "Levissima", "Sanpellegrino", "Peroni", "Moretti", "Santal"]),
+    "Prodotti da forno": (["Cornetti classici", "Fette biscottate", "Grissini", "Pane in cassetta", "Crackers", "Taralli"],
+                          ["Mulino Bianco", "Pan di Stelle", "Misura", "Bauli", "Buitoni", "Saiwa"]),
+    "Surgelati": (["Bastoncini di merluzzo", "Pisellini primavera", "Minestrone", "Pizza margherita", "Spinaci", "Misto mare"],
+                  ["Findus", "Orogel", "Buitoni", "Bofrost", "Surgela", "Capitan Findus"]),
+    "Dolci": (["Biscotti frollini", "Merendine", "Cioccolato fondente", "Wafer", "Crema spalmabile", "Pandoro"],
+              ["Ferrero", "Loacker", "Novi", "Lindt", "Balocco", "Galbusera"]),
+    "Conserve": (["Passata di pomodoro", "Pelati", "Tonno all'olio d'oliva", "Legumi misti", "Olive verdi", "Pesto alla genovese"],
+                 ["Mutti", "Cirio", "Rio Mare", "Star", "Valfrutta", "Barilla"]),
+    "Igiene casa": (["Detersivo piatti", "Ammorbidente", "Carta igienica", "Sgrassatore", "Detersivo lavatrice", "Candeggina"],
+                    ["Svelto", "Scottex", "Chanteclair", "Dash", "Lenor", "Ace"]),
+    "Frutta e verdura": (["Mele Golden", "Arance tarocco", "Pomodorini ciliegino", "Zucchine", "Patate novelle", "Banane"],
+                         ["Melinda", "Deco", "Oranfrizer", "Chiquita", "Bonduelle", "Valfrutta"]),
+}
+QUALIFIERS = ["", "bio", "integrale", "senza lattosio", "classico", "light", "gusto intenso", "formato famiglia"]
+SIZES = ["250 g", "500 g", "1 kg", "150 g", "400 g", "1 L", "1,5 L", "750 ml", "200 g", "6 x 125 g"]
+PACKS = ["", "x2", "x3", "x4", "x6", "conf. risparmio"]
+SUPERMARKETS = ["Supermercati Deco Arena", "Deco Catania", "Deco Palermo", "Deco Messina",
+                "Deco Siracusa", "Deco Ragusa", "Deco Agrigento", "Deco Trapani"]
+PRICE_FORMATS = ["{e},{c:02d}", "€ {e},{c:02d}", "{e}.{c:02d}", "{e},{c:02d} €", "{e},{c:02d} al kg"]
+
+
+def catalog_entries():
+    """Combinazioni (categoria, base, marca) in ordine stabile."""
+    return [(cat, base, brand) for cat, (bases, brands) in CATALOG.items() for base in bases for brand in brands]
+
+
+def generate_catalog(size, seed):
+    """`size` prodotti unici per (supermercato, nome), estratti senza ripetizioni dallo spazio delle combinazioni."""
+    rnd = random.Random(seed)
+    entries = catalog_entries()
+    dims = (len(entries), len(QUALIFIERS), len(SIZES), len(PACKS), len(SUPERMARKETS))
+    space = 1
+    for d in dims:
+        space *= d
+    if size > space:
+        raise SystemExit(f"Dimensione massima del catalogo sintetico: {space}")
+    products = []
+    for code in rnd.sample(range(space), size):
+        code, entry = divmod(code, dims[0])
+        code, qualifier = divmod(code, dims[1])
+        code, size_index = divmod(code, dims[2])
+        supermarket, pack = divmod(code, dims[3])
+        categoria, base, marca = entries[entry]
+        nome = " ".join(part for part in (base, marca, QUALIFIERS[qualifier], SIZES[size_index], PACKS[pack]) if part)
+        euros, cents = rnd.randint(0, 12), rnd.randint(0, 99)
+        products.append({
+            "nome": nome,
+            "marca": marca,
+            "categoria": categoria,
+            "prezzo": rnd.choice(PRICE_FORMATS).format(e=euros, c=cents),
+            "descrizione": f"{base} {marca}",
+            "pagina": rnd.randint(1, 24),
+            "supermercato": SUPERMARKETS[supermarket],
+            "volantino_name": f"Volantino {SUPERMARKETS[supermarket]}",
+        })
+    return products
+
+
+def load_files(workdir, job_id, products):
+    path = os.path.join(workdir, f"gemini_results_{job_id}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "method": "loadtest",
+                   "total_products": len(products), "products": products}, f, ensure_ascii=False)
+    return path
+
+
+def load_db(database_url, job_id, products, scratch, batch_size=5000):
+    """Carica il catalogo con DBManagerSQLAlchemy (stesso percorso di ingest della pipeline).
+
+    deco viene importato una sola volta, dalla cartella di appoggio, così i file di stato
+    creati all'avvio non finiscono nel repository.
+    """
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["DISK_PATH"] = scratch
+    sys.path.insert(0, REPO_DIR)
+    cwd = os.getcwd()
+    os.chdir(scratch)
+    try:
+        import deco
+    finally:
+        os.chdir(cwd)
+    if not deco.DB_ENABLED:
+        raise SystemExit("❌ Database non raggiungibile: controlla --database-url.")
+    session = deco.SessionLocal()
+    try:
+        session.query(deco.Product).filter(deco.Product.job_id.like("loadtest_%")).delete(synchronize_session=False)
+        session.commit()
+    finally:
+        session.close()
+    manager = deco.get_db_manager()
+    for start in range(0, len(products), batch_size):
+        manager.save_products(job_id, [dict(p) for p in products[start:start + batch_size]])
+
+
+class Server:
+    """Istanza di uvicorn su deco:app con la cartella di lavoro come directory corrente."""
+
+    def __init__(self, workdir, port, database_url=None):
+        env = dict(os.environ, PYTHONPATH=REPO_DIR + os.pathsep + os.environ.get("PYTHONPATH", ""),
+                   DISK_PATH=workdir, RESULTS_CATALOG_PATH=os.path.join(workdir, "results_catalog.sqlite3"))
+        env.pop("DATABASE_URL", None)
+        if database_url:
+            env["DATABASE_URL"] = database_url
+        self.base_url = f"http://127.0.0.1:{port}"
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "deco:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+            cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def wait(self, timeout=120):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise SystemExit("❌ Il server si è chiuso durante l'avvio.")
+            try:
+                if requests.get(self.base_url + "/health", timeout=1).ok:
+                    return
+            except requests.RequestException:
+                time.sleep(0.2)
+        raise SystemExit("❌ Il server non risponde.")
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def typo(word, rnd):
+    if len(word) < 5:
+        return word
+    i = rnd.randint(1, len(word) - 2)
+    return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+
+def scenarios(rnd):
+    """Generatori di richieste (metodo, path, parametri, body) per ogni scenario."""
+    entries = catalog_entries()
+    words = sorted({w.lower() for _, base, brand in entries for w in f"{base} {brand}".split() if len(w) > 3})
+
+    def products_page():
+        return "GET", "/products", {"page": rnd.randint(1, 50), "page_size": 20}, None
+
+    def products_filter():
+        cat, base, brand = rnd.choice(entries)
+        params = {"page_size": 20, "marca": brand} if rnd.random() < 0.5 else {"page_size": 20, "categoria": cat}
+        if rnd.random() < 0.5:
+            params["price_max"] = rnd.choice([1, 2, 5])
+        return "GET", "/products", params, None
+
+    cursors = threading.local()
+
+    def products_cursor():
+        # Scorre il catalogo seguendo next_cursor; ogni client riparte dall'inizio a fine elenco
+        params = {"page_size": 20, "count": "none"}
+        if getattr(cursors, "value", None):
+            params["cursor"] = cursors.value
+        return "GET", "/products", params, None
+
+    def follow_cursor(payload):
+        cursors.value = payload.get("next_cursor") if isinstance(payload, dict) else None
+
+    products_cursor.observe = follow_cursor
+
+    def products_latest():
+        return "GET", "/products/latest", {"page_size": 20}, None
+
+    def search():
+        word = rnd.choice(words)
+        return "GET", "/search", {"q": typo(word, rnd) if rnd.random() < 0.2 else word, "page_size": 20}, None
+
+    def compare():
+        items = []
+        for _ in range(5):
+            _, base, brand = rnd.choice(entries)
+            items.append({"nome": base, "marca": brand if rnd.random() < 0.5 else None, "qty": rnd.randint(1, 3)})
+        return "POST", "/compare", None, {"items": items}
+
+    return {"products_page": products_page, "products_filter": products_filter,
+            "products_cursor": products_cursor, "products_latest": products_latest,
+            "search": search, "compare": compare}
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))]
+
+
+def drive(base_url, make_request, concurrency, duration):
+    """Richieste continue da `concurrency` thread per `duration` secondi."""
+    latencies, errors = [], 0
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+    observe = getattr(make_request, "observe", None)
+
+    def worker():
+        nonlocal errors
+        session = requests.Session()
+        local, local_errors = [], 0
+        while time.monotonic() < deadline:
+            method, path, params, body = make_request()
+            start = time.perf_counter()
+            try:
+                response = session.request(method, base_url + path, params=params, json=body, timeout=60)
+                ok = response.status_code < 400
+                if ok and observe is not None:
+                    observe(response.json())
+            except (requests.RequestException, ValueError):
+                ok = False
+            local.append(time.perf_counter() - start)
+            local_errors += 0 if ok else 1
+        with lock:
+            latencies.extend(local)
+            errors += local_errors
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "max_ms": round(max(latencies) * 1000, 1) if latencies else 0.0,
+    }
+
+
+def run_mode(mode, size, args, products):
+    workdir = tempfile.mkdtemp(prefix=f"deco_load_{mode}_{size}_")
+    job_id = f"loadtest_{size}"
+    database_url = None
+    t0 = time.perf_counter()
+    if mode == "file":
+        load_files(workdir, job_id, products)
+    else:
+        database_url = args.database_url
+        load_db(database_url, job_id, products, args.scratch)
+    load_seconds = time.perf_counter() - t0
+
+    server = Server(workdir, args.port, database_url)
+    try:
+        server.wait()
+        rnd = random.Random(args.seed)
+        report = {"mode": mode, "size": size, "load_seconds": round(load_seconds, 1), "scenarios": {}}
+        for name, make_request in scenarios(rnd).items():
+            if args.scenario and name not in args.scenario:
+                continue
+            # Prima richiesta isolata: misura il costo a freddo (indici in memoria, cache del DB)
+            method, path, params, body = make_request()
+            start = time.perf_counter()
+            requests.request(method, server.base_url + path, params=params, json=body, timeout=600)
+            cold_ms = round((time.perf_counter() - start) * 1000, 1)
+            stats = drive(server.base_url, make_request, args.concurrency, args.duration)
+            report["scenarios"][name] = {"cold_ms": cold_ms, **stats}
+            print(f"  {mode:<4} {size:>8} {name:<16} {stats['rps']:>8} req/s  p50 {stats['p50_ms']:>8} ms  "
+                  f"p95 {stats['p95_ms']:>8} ms  p99 {stats['p99_ms']:>8} ms  errori {stats['errors']}  (a freddo {cold_ms} ms)")
+        return report
+    finally:
+        server.stop()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, action="append", help="prodotti nel catalogo (ripetibile; default 10000)")
+    parser.add_argument("--mode", choices=("file", "db", "both"), default="file")
+    parser.add_argument("--database-url", help="DB per la modalità db (default DATABASE_URL o SQLite temporaneo)")
+    parser.add_argument("--concurrency", type=int, default=8, help="client in parallelo")
+    parser.add_argument("--duration", type=float, default=15, help="secondi per scenario")
+    parser.add_argument("--scenario", action="append", help="limita a questi scenari (ripetibile)")
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--keep", action="store_true", help="non cancellare le cartelle di lavoro")
+    parser.add_argument("--json", help="scrive anche il report in questo file JSON")
+    args = parser.parse_args()
+
+    modes = ("file", "db") if args.mode == "both" else (args.mode,)
+    args.scratch = tempfile.mkdtemp(prefix="deco_load_")
+    # Senza Postgres la modalità db usa un SQLite condiviso tra le taglie (le righe loadtest_* vengono sostituite)
+    args.database_url = args.database_url or os.getenv("DATABASE_URL") or f"sqlite:///{os.path.join(args.scratch, 'loadtest.sqlite3')}"
+    reports = []
+    print("📊 Load test endpoint di lettura")
+    for size in args.size or [10000]:
+        t0 = time.perf_counter()
+        products = generate_catalog(size, args.seed)
+        print(f"🧪 Catalogo di {size} prodotti generato in {time.perf_counter() - t0:.1f}s")
+        for mode in modes:
+            reports.append(run_mode(mode, size, args, products))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(reports, f, indent=2)
+    if not args.keep:
+        shutil.rmtree(args.scratch, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,15 @@
+"""Rendering delle pagine PDF in JPEG, importabile dai processi worker senza caricare l'intero servizio."""
+import fitz  # PyMuPDF
+
+
+def render_page_jpeg(page, max_side, quality):
+    """Renderizza una pagina alla risoluzione di analisi (al massimo 2x, lato lungo <= max_side) e restituisce i byte JPEG."""
+    zoom = min(2.0, max_side / max(page.rect.width, page.rect.height))
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    return pix.tobytes("jpeg", jpg_quality=quality)
+
+
+def render_pages(pdf_path, page_numbers, max_side, quality):
+    """Eseguita nei processi del pool: apre il documento e renderizza una porzione di pagine (numerate da 1)."""
+    with fitz.open(pdf_path) as doc:
+        return [(page_number, render_page_jpeg(doc.load_page(page_number - 1), max_side, quality)) for page_number in page_numbers]